@@ -0,0 +1,366 @@
+"""
+Offline benchmark of the download pipeline.
+
+Replays a synthetic (or recorded) playlist through get_items_from_spotify, download_song,
+encode_track and the streaming ZIP, with a stub Spotify API and a stub yt-dlp that hands out
+generated audio files. The audio is converted by the real FFmpeg, so the CPU side is measured
+as it is in production, while the network side is simulated with configurable latencies.
+
+Usage:
+    python benchmark.py --tracks 10 100 1000 --ffmpeg /usr/bin/ffmpeg
+    python benchmark.py --playlist recorded_playlist.json --search-latency 0.8 --fetch-latency 2
+    python benchmark.py --tracks 20 --opposite-orders --track-workers 1
+
+With --opposite-orders the playlist is downloaded by two jobs at once, one of them in reverse
+order, which share the tracks through the track cache. The benchmark fails if they don't finish
+within --timeout or leave tracks claimed.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the download pipeline without network access.")
+    parser.add_argument("--tracks", type=int, nargs="+", default=[10, 100],
+                        help="Playlist sizes to run (default: 10 100)")
+    parser.add_argument("--playlist", help="Recorded Spotify playlist JSON (response of sp.playlist or a list of tracks)")
+    parser.add_argument("--ffmpeg", default=shutil.which("ffmpeg") or os.path.join(REPO_DIR, "ast", "ffmpeg.exe"),
+                        help="FFmpeg binary used for the generated audio and the conversion")
+    parser.add_argument("--track-seconds", type=float, default=30, help="Length of the generated audio")
+    parser.add_argument("--search-latency", type=float, default=0.0, help="Simulated YouTube search time (s)")
+    parser.add_argument("--fetch-latency", type=float, default=0.0, help="Simulated YouTube download time (s)")
+    parser.add_argument("--youtube-rate", type=float, default=1000,
+                        help="YouTube calls per second allowed by the rate limiter (default: practically unlimited)")
+    parser.add_argument("--format", default="mp3", choices=["mp3", "m4a", "opus"],
+                        help="Output format (m4a and opus copy the source audio when they can)")
+    parser.add_argument("--quality", default="192", help="MP3 bitrate (kbps)")
+    parser.add_argument("--metadata", default="all", help="Metadata option (all, basic, minimal, none)")
+    parser.add_argument("--track-workers", type=int, help="Track workers per job (default: SSSSD_TRACK_WORKERS)")
+    parser.add_argument("--opposite-orders", action="store_true",
+                        help="Run the playlist as two concurrent jobs, as is and in reverse order")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds the jobs may take before the run fails")
+    parser.add_argument("--warm", action="store_true", help="Keep the caches between runs instead of starting cold")
+    parser.add_argument("--json", help="Also write the results to this file")
+    return parser.parse_args()
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class DiskSampler:
+    """Samples the size of the given folders in the background and keeps the peak."""
+    def __init__(self, paths, interval=0.2):
+        self.paths = paths
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, sum(dir_size(p) for p in self.paths))
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, sum(dir_size(p) for p in self.paths))
+
+
+def synthetic_track(n, track_seconds):
+    return {
+        "id": f"bench{n:06d}",
+        "name": f"Benchmark Song {n}",
+        "artists": [{"name": f"Benchmark Artist {n % 17}"}],
+        "duration_ms": int(track_seconds * 1000),
+        "track_number": n,
+        "disc_number": 1,
+        "album": {"name": f"Benchmark Album {n % 23}", "release_date": "2020-01-01", "images": []},
+    }
+
+
+def load_recorded_tracks(path):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = [item.get("track") for item in data.get("tracks", {}).get("items", [])]
+    tracks = [t for t in data if t]
+    for track in tracks:
+        # Cover downloads would need the network, the default thumbnail is used instead
+        track.get("album", {}).pop("images", None)
+    return tracks
+
+
+class StubSpotify:
+    """Serves one playlist in pages of 100 like the Web API does."""
+    page_size = 100
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+
+    def page(self, offset, limit):
+        items = [{"track": t} for t in self.tracks[offset:offset + limit]]
+        has_next = offset + limit < len(self.tracks)
+        return {"items": items, "total": len(self.tracks), "limit": limit, "offset": offset,
+                "next": "stub" if has_next else None}
+
+    def playlist(self, playlist_id):
+        return {"id": playlist_id, "name": "Benchmark Playlist", "snapshot_id": "bench",
+                "tracks": self.page(0, self.page_size)}
+
+    def playlist_items(self, playlist_id, limit=100, offset=0, **kwargs):
+        return self.page(offset, limit)
+
+    def track(self, track_id):
+        return next(t for t in self.tracks if t["id"] == track_id)
+
+
+def make_stub_youtube_dl(source_path, search_latency, fetch_latency, track_seconds):
+    """Returns a YoutubeDL stand-in that "downloads" a copy of source_path for every video."""
+    class StubYoutubeDL:
+        def __init__(self, opts):
+            self.opts = opts
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def extract_info(self, url, download=False, **kwargs):
+            if url.startswith("ytsearch"):
+                time.sleep(search_latency)
+                prefix, query = url.split(":", 1)
+                count = int(prefix[len("ytsearch"):] or 1)
+                entries = []
+                for n in range(count):
+                    # The first results are other versions of different length, like a real search
+                    video_id = f"stub{abs(hash((query, n))) % 10 ** 8:08d}"
+                    entries.append({"id": video_id, "title": query if n == count // 2 else f"{query} (live)",
+                                    "duration": track_seconds + (0 if n == count // 2 else 45 * (n + 1)),
+                                    "channel": "Stub", "url": f"https://www.youtube.com/watch?v={video_id}"})
+                return {"entries": entries}
+            video_id = url.rsplit("=", 1)[-1]
+            ext = os.path.splitext(source_path)[1].lstrip(".")
+            info = {"id": video_id, "title": video_id, "ext": ext, "webpage_url": url,
+                    "duration": track_seconds, "acodec": "opus"}
+            if download:
+                template = self.opts["outtmpl"]
+                if isinstance(template, dict):
+                    template = template["default"]
+                path = template.replace("%(ext)s", ext).replace("%(id)s", video_id)
+                size = os.path.getsize(source_path)
+                hooks = self.opts.get("progress_hooks", [])
+                for hook in hooks:
+                    hook({"status": "downloading", "downloaded_bytes": 0, "total_bytes": size, "filename": path})
+                time.sleep(fetch_latency)
+                shutil.copyfile(source_path, path)
+                for hook in hooks:
+                    hook({"status": "finished", "downloaded_bytes": size, "total_bytes": size, "filename": path})
+                info["requested_downloads"] = [{"filepath": path}]
+            return info
+
+        def download(self, urls):
+            for url in urls:
+                self.extract_info(url, download=True)
+            return 0
+
+        def prepare_filename(self, info):
+            template = self.opts["outtmpl"]
+            if isinstance(template, dict):
+                template = template["default"]
+            return template.replace("%(ext)s", info["ext"]).replace("%(id)s", info["id"])
+
+    return StubYoutubeDL
+
+
+def generate_source(ffmpeg, path, seconds):
+    cmd = [ffmpeg, "-y", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+           "-c:a", "libopus", "-b:a", "128k", path]
+    subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+
+def reset_caches(main):
+    for path in (main.DOWNLOADS_DIR, os.path.dirname(main.TRACK_CACHE_DIR)):
+        shutil.rmtree(path, ignore_errors=True)
+    main.match_db_ready = False
+    with main.spotify_cache_lock:
+        main.spotify_cache.clear()
+
+
+def run_once(main, tracks, args):
+    stub = StubSpotify(tracks)
+    main.get_spotify_client = lambda: stub
+    if not args.warm:
+        reset_caches(main)
+
+    samples = {}
+    samples_lock = threading.Lock()
+    observe_stage = main.observe_stage
+
+    def record_stage(stage, seconds):
+        with samples_lock:
+            samples.setdefault(stage, []).append(seconds)
+        observe_stage(stage, seconds)
+    main.observe_stage = record_stage
+
+    options = {"spotify_url": "https://open.spotify.com/playlist/benchmark", "url_type": "playlist",
+               "spotify_id": "benchmark", "sound_quality": args.quality, "playlist_order": "as_is",
+               "metadata_option": args.metadata, "audio_format": args.format}
+    orders = ["as_is", "reverse"] if args.opposite_orders else ["as_is"]
+    cache_root = os.path.dirname(main.TRACK_CACHE_DIR)
+    try:
+        with DiskSampler([main.DOWNLOADS_DIR, cache_root]) as disk:
+            start = time.perf_counter()
+            job_ids = [main.create_job(dict(options, playlist_order=order)) for order in orders]
+            # Daemon threads, so a run that never finishes doesn't keep the benchmark alive
+            threads = [threading.Thread(target=main.run_job, args=(job_id,), daemon=True) for job_id in job_ids]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(max(0, start + args.timeout - time.perf_counter()))
+            stuck = any(thread.is_alive() for thread in threads)
+            pipeline_seconds = time.perf_counter() - start
+            jobs = [main.get_job(job_id) for job_id in job_ids]
+            zip_bytes = 0
+            for job_id, job in zip(job_ids, jobs):
+                if job["zip_file"] and not stuck:
+                    for chunk in main.stream_zip(main.iter_job_entries(job_id)):
+                        zip_bytes += len(chunk)
+            total_seconds = time.perf_counter() - start
+    finally:
+        main.observe_stage = observe_stage
+
+    error = next((job["error"] for job in jobs if job["error"]), None)
+    if stuck:
+        error = f"jobs still running after {args.timeout:.0f} s"
+    elif main.inflight_tracks:
+        error = f"{len(main.inflight_tracks)} tracks left claimed"
+    result = {
+        "tracks": len(tracks),
+        "jobs": len(jobs),
+        "delivered": sum(len(job["entries"]) or len(job["files"] or []) for job in jobs),
+        "status": "stuck" if stuck else ", ".join(sorted({job["status"] for job in jobs})),
+        "error": error,
+        "failed": stuck or bool(main.inflight_tracks),
+        "pipeline_seconds": pipeline_seconds,
+        "total_seconds": total_seconds,
+        "tracks_per_second": len(tracks) * len(jobs) / total_seconds if total_seconds else None,
+        "zip_bytes": zip_bytes,
+        "peak_disk_bytes": disk.peak,
+        "stages": {stage: {"count": len(values),
+                           "p50_ms": percentile(values, 50) * 1000,
+                           "p99_ms": percentile(values, 99) * 1000}
+                   for stage, values in sorted(samples.items())},
+    }
+    if resource:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        result["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        result["peak_child_rss_bytes"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return result
+
+
+def print_result(result):
+    mb = 1024 * 1024
+    jobs = f" x {result['jobs']} jobs" if result["jobs"] > 1 else ""
+    print(f"\n{result['tracks']} tracks{jobs}: {result['status']}, {result['delivered']} delivered"
+          + (f" ({result['error']})" if result["error"] else ""))
+    print(f"  wall time     {result['total_seconds']:.2f} s ({result['pipeline_seconds']:.2f} s before the ZIP)")
+    print(f"  throughput    {result['tracks_per_second']:.2f} tracks/s")
+    print(f"  peak disk     {result['peak_disk_bytes'] / mb:.1f} MB, ZIP {result['zip_bytes'] / mb:.1f} MB")
+    if "peak_rss_bytes" in result:
+        print(f"  peak RSS      {result['peak_rss_bytes'] / mb:.1f} MB (largest FFmpeg {result['peak_child_rss_bytes'] / mb:.1f} MB)")
+    print(f"  {'stage':<16}{'count':>8}{'p50 ms':>12}{'p99 ms':>12}")
+    for stage, stats in result["stages"].items():
+        print(f"  {stage:<16}{stats['count']:>8}{stats['p50_ms']:>12.1f}{stats['p99_ms']:>12.1f}")
+
+
+def main_benchmark():
+    args = parse_args()
+    args.json = os.path.abspath(args.json) if args.json else None
+    args.playlist = os.path.abspath(args.playlist) if args.playlist else None
+    if not os.path.exists(args.ffmpeg):
+        sys.exit(f"FFmpeg not found at {args.ffmpeg}, pass --ffmpeg")
+
+    # main.py works relative to the current folder, so it runs in a scratch folder
+    work_dir = tempfile.mkdtemp(prefix="ssssd-bench-")
+    os.chdir(work_dir)
+    if os.path.exists(os.path.join(REPO_DIR, "d.png")):
+        shutil.copy(os.path.join(REPO_DIR, "d.png"), "d.png")
+    source_path = os.path.join(work_dir, "source.webm")
+    generate_source(args.ffmpeg, source_path, args.track_seconds)
+
+    import yt_dlp
+    yt_dlp.YoutubeDL = make_stub_youtube_dl(source_path, args.search_latency, args.fetch_latency,
+                                            args.track_seconds)
+    if args.track_workers:
+        # Read by main.py when it is imported
+        os.environ["SSSSD_TRACK_WORKERS"] = str(args.track_workers)
+    sys.path.insert(0, REPO_DIR)
+    import main
+    main.FFMPEG_BIN = args.ffmpeg
+    main.rate_limiters["youtube"] = main.TokenBucket(args.youtube_rate, max(1, int(args.youtube_rate)))
+    main.logger.setLevel("WARNING")
+
+    if args.playlist:
+        runs = [load_recorded_tracks(args.playlist)]
+    else:
+        runs = [[synthetic_track(n, args.track_seconds) for n in range(1, size + 1)] for size in args.tracks]
+
+    results = []
+    try:
+        for tracks in runs:
+            result = run_once(main, tracks, args)
+            print_result(result)
+            results.append(result)
+            if result["failed"]:
+                break
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if results[-1]["failed"]:
+        print(f"\nBenchmark failed: {results[-1]['error']}", file=sys.stderr)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # The threads of stuck jobs would keep Python from exiting
+        os._exit(1)
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,14 @@
+# Gunicorn settings:  gunicorn -c gunicorn.conf.py wsgi:app
+import os
+
+bind = f"{os.environ.get('SSSSD_HOST', '0.0.0.0')}:{os.environ.get('SSSSD_PORT', '5000')}"
+# Jobs, progress and the caches are kept in the process, so there is one worker process.
+# Threads serve the requests; progress (SSE) and ZIP streams hold one each for their duration.
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("SSSSD_SERVER_THREADS", "32"))
+# Finished files go out through os.sendfile instead of being copied through Python
+sendfile = True
+keepalive = 5
+# Give running streams a moment to finish on restart
+graceful_timeout = 30
@@ -1,589 +1,3038 @@
-import os
-import re
-import logging
-import time
-import threading
-import shutil
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-import yt_dlp
-import zipfile
-import requests
-import subprocess
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory
-from jinja2 import DictLoader
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("spotify_downloader")
-
-# Define FFmpeg binary path from the "ast" folder (adjust for Windows as needed)
-FFMPEG_BIN = os.path.join(os.getcwd(), "ast", "ffmpeg.exe")
-# Default thumbnail fallback from main directory
-DEFAULT_THUMB = os.path.join(os.getcwd(), "d.png")
-
-# Initialize Flask app
-app = Flask(__name__)
-app.secret_key = 'supersecretkey'
-
-# Define custom CSS style (no Bootstrap)
-custom_css = """
-<style>
-    html {
-        background:black;
-    }
-  body {
-      font-family: 'Helvetica Neue', Arial, sans-serif;
-      background: black;
-      color:white;
-      margin: 0;
-      padding: 0;
-      height:100%;
-      width:100%;
-  }
-  .navbar {
-      background-color: black;
-      color: #fff;
-      padding: 15px;
-      text-align: center;
-  }
-  .navbar h1 {
-      margin: 0;
-      font-size: 24px;
-  }
-  .container {
-      width: 90%;
-      max-width: 800px;
-      margin: 30px auto;
-      background-color: black;
-      box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-      padding: 20px;
-      border-radius: 8px;
-  }
-  h2 {
-      color: white;
-      text-align: center;
-      margin-bottom: 20px;
-  }
-  form {
-    display:flex;
-    flex-direction:column;
-  }
-  form label {
-      font-weight: bold;
-      display: block;
-      margin-bottom: 5px;
-  }
-  form input[type="text"], form select {
-      padding: 10px;
-      border: 1px solid #ccc;
-      border-radius: 4px;
-      margin-bottom: 15px;
-      background:black;
-      color:white;
-  }
-  form button {
-      background-color: black;
-      color: white;
-      outline:1px solid white;
-      border: none;
-      padding: 8px 15px;
-      border-radius: 4px;
-      cursor: pointer;
-  }
-  form button:hover {
-      background-color: #0056b3;
-  }
-  .alert {
-      padding: 10px 15px;
-      margin-bottom: 20px;
-      border-radius: 4px;
-  }
-  .alert-info {
-      background-color: black;
-      color: white;
-  }
-  .alert-success {
-      background-color: black;
-      color: white;
-  }
-  .alert-danger {
-      background-color: black;
-      color: red;
-  }
-  a {
-      color: #007bff;
-      text-decoration: none;
-  }
-  a:hover {
-      text-decoration: underline;
-  }
-  .btn-secondary {
-      background-color: black;
-      color: white;
-      outline:1px solid white;
-      border: none;
-      padding: 8px 15px;
-      border-radius: 4px;
-      cursor: pointer;
-  }
-  .btn-secondary:hover {
-      background-color: #5a6268;
-  }
-</style>
-"""
-
-# Define HTML templates using custom CSS
-base_template = f"""
-<!doctype html>
-<html lang="en">
-  <head>
-    <meta charset="utf-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <title>SilverSniper-SpotifyDownloader</title>
-    {custom_css}
-  </head>
-  <body>
-    <div class="navbar">
-      <h1>SilverSniper-SpotifyDownloader</h1>
-    </div>
-    <div class="container">
-      {{% with messages = get_flashed_messages() %}}
-        {{% if messages %}}
-          <div class="alert alert-info">
-            {{% for message in messages %}}
-              <div>{{{{ message }}}}</div>
-            {{% endfor %}}
-          </div>
-        {{% endif %}}
-      {{% endwith %}}
-      {{% block content %}}{{% endblock %}}
-    </div>
-  </body>
-</html>
-"""
-
-home_template = """
-{% extends "base.html" %}
-{% block content %}
-  <h2>Enter Spotify URL</h2>
-  <form method="post" action="{{ url_for('download') }}">
-    <label for="spotify_url">Spotify URL (track, album, or playlist):</label>
-    <input type="text" id="spotify_url" name="spotify_url" placeholder="https://open.spotify.com/track/..." required>
-
-    <label for="sound_quality">Sound Quality (kbps):</label>
-    <select id="sound_quality" name="sound_quality">
-      <option value="64">64</option>
-      <option value="128">128</option>
-      <option value="192" selected>192</option>
-      <option value="320">320</option>
-    </select>
-
-    <!-- Dropdown for metadata options -->
-    <label for="metadata_options">Metadata Options:</label>
-    <select id="metadata_options" name="metadata_options">
-      <option value="all" selected>All (Title, Artist, Album, Date, Track Number, Disc Number, Thumbnail)</option>
-      <option value="basic">Basic (Title, Artist)</option>
-      <option value="minimal">Minimal (Title only)</option>
-      <option value="none">None</option>
-    </select>
-
-    <label for="playlist_order">Playlist Order:</label>
-    <select id="playlist_order" name="playlist_order">
-      <option value="as_is" selected>As Is</option>
-      <option value="reverse">Reverse</option>
-    </select>
-
-    <button type="submit">Download</button>
-  </form>
-{% endblock %}
-"""
-
-result_template = """
-{% extends "base.html" %}
-{% block content %}
-  <h2>Download Results</h2>
-  {% if error %}
-    <div class="alert alert-danger">{{ error }}</div>
-  {% else %}
-    {% if zip_file %}
-      <div class="alert alert-success">Successfully created ZIP archive:</div>
-      <ul>
-        <li><a href="{{ url_for('downloaded_file', filename=zip_file) }}">{{ zip_file }}</a></li>
-      </ul>
-    {% else %}
-      <div class="alert alert-success">Successfully downloaded the file:</div>
-      <ul>
-        {% for file in files %}
-          <li><a href="{{ url_for('downloaded_file', filename=file) }}">{{ file }}</a></li>
-        {% endfor %}
-      </ul>
-    {% endif %}
-  {% endif %}
-  <a class="btn-secondary" href="{{ url_for('home') }}">Back</a>
-{% endblock %}
-"""
-
-# Set up a Jinja2 DictLoader with our templates
-app.jinja_loader = DictLoader({
-    "base.html": base_template,
-    "home.html": home_template,
-    "result.html": result_template,
-})
-
-def get_items_from_spotify(sp, url_type, spotify_id):
-    if url_type == "track":
-        track = sp.track(spotify_id)
-        return [track], track.get("name", "Track")
-    elif url_type == "album":
-        album = sp.album(spotify_id)
-        # Fetch album tracks (handle pagination if needed)
-        tracks = album.get("tracks", {}).get("items", [])
-        return tracks, album.get("name", "Album")
-    elif url_type == "playlist":
-        playlist = sp.playlist(spotify_id)
-        # Playlist items usually wrap the track info inside a "track" key.
-        tracks = [item["track"] for item in playlist.get("tracks", {}).get("items", []) if item.get("track")]
-        return tracks, playlist.get("name", "Playlist")
-    else:
-        raise ValueError("Invalid Spotify URL type.")
-
-@app.route("/")
-def home():
-    return render_template("home.html")
-
-@app.route("/download", methods=["POST"])
-def download():
-    spotify_url = request.form.get("spotify_url", "").strip()
-    if not spotify_url:
-        flash("Please provide a Spotify URL.")
-        return redirect(url_for("home"))
-    
-    url_type, spotify_id = extract_spotify_id(spotify_url)
-    if not url_type or not spotify_id:
-        error = "Invalid Spotify URL."
-        return render_template("result.html", error=error, files=None, zip_file=None)
-    
-    # Retrieve extra options from the form
-    sound_quality = request.form.get("sound_quality", "192")
-    playlist_order = request.form.get("playlist_order", "as_is")
-    
-    # Retrieve metadata options from dropdown and set flags accordingly:
-    metadata_option = request.form.get("metadata_options", "all")
-    if metadata_option == "all":
-        include_title = include_artist = include_album = include_date = include_track = include_disc = include_thumbnail = True
-    elif metadata_option == "basic":
-        include_title = include_artist = True
-        include_album = include_date = include_track = include_disc = include_thumbnail = False
-    elif metadata_option == "minimal":
-        include_title = True
-        include_artist = include_album = include_date = include_track = include_disc = include_thumbnail = False
-    elif metadata_option == "none":
-        include_title = include_artist = include_album = include_date = include_track = include_disc = include_thumbnail = False
-    else:
-        include_title = include_artist = include_album = include_date = include_track = include_disc = include_thumbnail = True
-
-
-
-
-#Paste your id and that here
-
-
-
-
-
-
-#------------------------------------
-
-
-
-    client_id = ""
-    client_secret = ""
-
-
-
-
-#-------------------------------------
-
-
-
-
-
-
-
-
-
-
-
-
-    sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=client_id,
-                                                               client_secret=client_secret))
-    try:
-        items, collection_name = get_items_from_spotify(sp, url_type, spotify_id)
-        # If user selects reverse order, reverse the items list
-        if url_type == "playlist" and playlist_order == "reverse":
-            items.reverse()
-    except Exception as e:
-        error = f"Failed to fetch items: {e}"
-        return render_template("result.html", error=error, files=None, zip_file=None)
-    
-    downloads_dir = os.path.join(os.getcwd(), "downloads")
-    os.makedirs(downloads_dir, exist_ok=True)
-    
-    # For single track downloads
-    if url_type == "track" or len(items) == 1:
-        track = items[0]
-        query = build_query(track)
-        logger.info(f"Search query: {query}")
-        artist = ", ".join([a["name"] for a in track.get("artists", [])])
-        title = track.get("name", "")
-        base_filename = sanitize_filename(f"{artist} - {title}")
-        output_path = None
-        for attempt in range(3):
-            output_path = download_song(query, downloads_dir, base_filename, ffmpeg_path=FFMPEG_BIN, sound_quality=sound_quality)
-            if output_path:
-                try:
-                    embed_metadata_ffmpeg(output_path, track, ffmpeg_bin=FFMPEG_BIN,
-                                            include_title=include_title,
-                                            include_artist=include_artist,
-                                            include_album=include_album,
-                                            include_date=include_date,
-                                            include_track=include_track,
-                                            include_disc=include_disc,
-                                            include_thumbnail=include_thumbnail)
-                    break
-                except Exception as e:
-                    logger.error(f"Embedding metadata failed on attempt {attempt+1}: {e}")
-                    output_path = None
-            time.sleep(1)
-        if output_path:
-            files = [os.path.basename(output_path)]
-            return render_template("result.html", files=files, error=None, zip_file=None)
-        else:
-            error = "Failed to download the song after multiple attempts."
-            return render_template("result.html", error=error, files=None, zip_file=None)
-    else:
-        # For album or playlist downloads (sequential processing)
-        collection_folder = os.path.join(downloads_dir, sanitize_filename(collection_name))
-        os.makedirs(collection_folder, exist_ok=True)
-        logger.info(f"Downloading {len(items)} tracks into folder '{collection_folder}'")
-        
-        def process_track(track):
-            output = None
-            for attempt in range(3):
-                q = build_query(track)
-                artist = ", ".join([a["name"] for a in track.get("artists", [])])
-                title = track.get("name", "")
-                base_fn = sanitize_filename(f"{artist} - {title}")
-                logger.info(f"Downloading track: {base_fn}")
-                output = download_song(q, collection_folder, base_fn, ffmpeg_path=FFMPEG_BIN, sound_quality=sound_quality)
-                if output:
-                    try:
-                        embed_metadata_ffmpeg(output, track, ffmpeg_bin=FFMPEG_BIN,
-                                                include_title=include_title,
-                                                include_artist=include_artist,
-                                                include_album=include_album,
-                                                include_date=include_date,
-                                                include_track=include_track,
-                                                include_disc=include_disc,
-                                                include_thumbnail=include_thumbnail)
-                        break
-                    except Exception as e:
-                        logger.error(f"Embedding metadata for '{base_fn}' failed on attempt {attempt+1}: {e}")
-                        output = None
-                time.sleep(1)
-            return output
-        
-        # Process each track sequentially
-        for track in items:
-            process_track(track)
-        
-        # At final encoding, rename files based on order from Spotify data.
-        # Use the current order of the 'items' list (which may be reversed if selected).
-        for idx, track in enumerate(items, start=1):
-            artist = ", ".join([a["name"] for a in track.get("artists", [])])
-            title = track.get("name", "")
-            base_fn = sanitize_filename(f"{artist} - {title}")
-            original_path = os.path.join(collection_folder, f"{base_fn}.mp3")
-            if os.path.exists(original_path):
-                new_path = os.path.join(collection_folder, f"{idx:02d} - {base_fn}.mp3")
-                try:
-                    os.rename(original_path, new_path)
-                except Exception as e:
-                    logger.error(f"Error renaming file {original_path} to {new_path}: {e}")
-        
-        zip_file_name = sanitize_filename(collection_name) + ".zip"
-        zip_file_path = os.path.join(downloads_dir, zip_file_name)
-        zip_folder(collection_folder, zip_file_path)
-        logger.info(f"Created ZIP file: {zip_file_path}")
-        return render_template("result.html", files=None, error=None, zip_file=zip_file_name)
-
-@app.route("/downloads/<path:filename>")
-def downloaded_file(filename):
-    downloads_dir = os.path.join(os.getcwd(), "downloads")
-    return send_from_directory(downloads_dir, filename)
-
-def zip_folder(source_dir, zip_file_path):
-    """Zip the contents of source_dir into a zip file at zip_file_path."""
-    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, source_dir)
-                zipf.write(file_path, arcname)
-
-# Updated download_song accepts a new parameter 'sound_quality'
-def download_song(query, downloads_dir, base_filename, ffmpeg_path=FFMPEG_BIN, sound_quality="192"):
-    output_template = os.path.join(downloads_dir, f"{base_filename}.%(ext)s")
-    final_filename = f"{base_filename}.mp3"
-    final_path = os.path.join(downloads_dir, final_filename)
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "outtmpl": output_template,
-        "noplaylist": True,
-        "quiet": True,
-        "ffmpeg_location": ffmpeg_path,
-        "retries": 3,
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": sound_quality
-        }],
-    }
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info("ytsearch:" + query, download=False)
-            if "entries" in info and len(info["entries"]) > 0:
-                video = info["entries"][0]
-                video_url = video.get("webpage_url")
-                logger.info(f"Found video: {video_url}")
-                ydl.download([video_url])
-                if os.path.exists(final_path):
-                    return final_path
-    except Exception as e:
-        logger.error(f"Error downloading song: {e}")
-    return None
-
-def embed_metadata_ffmpeg(file_path, track, ffmpeg_bin=FFMPEG_BIN, attempts=3,
-                          include_title=True, include_artist=True, include_album=True,
-                          include_date=True, include_track=True, include_disc=True,
-                          include_thumbnail=True):
-    """
-    Re-invokes FFmpeg to embed metadata (title, artist, album, date, track, disc, and cover image)
-    into the MP3 file. Retries up to 'attempts' times.
-    If album art download fails, falls back to default thumbnail "d.png".
-    """
-    for attempt in range(attempts):
-        try:
-            metadata_opts = []
-            if include_title:
-                t = track.get("name", "")
-                if t:
-                    metadata_opts.extend(["-metadata", f"title={t}"])
-            if include_artist:
-                artists = ", ".join([a["name"] for a in track.get("artists", [])])
-                if artists:
-                    metadata_opts.extend(["-metadata", f"artist={artists}"])
-            if include_album and "album" in track:
-                album_name = track["album"].get("name", "")
-                if album_name:
-                    metadata_opts.extend(["-metadata", f"album={album_name}"])
-                if include_date:
-                    release_date = track["album"].get("release_date", "")
-                    if release_date:
-                        metadata_opts.extend(["-metadata", f"date={release_date}"])
-            if include_track and "track_number" in track:
-                metadata_opts.extend(["-metadata", f"track={track.get('track_number', '')}"])
-            if include_disc and "disc_number" in track:
-                metadata_opts.extend(["-metadata", f"disc={track.get('disc_number', '')}"])
-            
-            album_art_path = None
-            if include_thumbnail:
-                if "album" in track and track["album"].get("images"):
-                    image_url = track["album"]["images"][0]["url"]
-                    try:
-                        response = requests.get(image_url)
-                        if response.status_code == 200:
-                            album_art_path = os.path.join(os.path.dirname(file_path), "cover.jpg")
-                            with open(album_art_path, "wb") as f:
-                                f.write(response.content)
-                        else:
-                            raise Exception("Non-200 response")
-                    except Exception as e:
-                        logger.error(f"Error downloading album art: {e}")
-                if album_art_path is None or not os.path.exists(album_art_path):
-                    if os.path.exists(DEFAULT_THUMB):
-                        album_art_path = DEFAULT_THUMB
-                        logger.info("Using default thumbnail.")
-                    else:
-                        logger.warning("No album art available and default thumbnail not found.")
-                        album_art_path = None
-            
-            temp_output = file_path + ".temp.mp3"
-            if album_art_path:
-                cmd = [ffmpeg_bin, "-y", "-i", file_path, "-i", album_art_path, "-map", "0:0", "-map", "1:0",
-                       "-c", "copy", "-id3v2_version", "3"] + metadata_opts + [temp_output]
-            else:
-                cmd = [ffmpeg_bin, "-y", "-i", file_path, "-c", "copy", "-id3v2_version", "3"] + metadata_opts + [temp_output]
-            
-            logger.info("Running FFmpeg for metadata embedding: " + " ".join(cmd))
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if result.returncode == 0:
-                os.replace(temp_output, file_path)
-                if album_art_path and album_art_path != DEFAULT_THUMB and os.path.exists(album_art_path):
-                    time.sleep(1)
-                    try:
-                        os.remove(album_art_path)
-                    except Exception as e:
-                        logger.warning(f"Could not remove album art file: {e}")
-                return
-            else:
-                logger.error("FFmpeg metadata embedding failed: " + result.stderr.decode("utf-8"))
-        except Exception as e:
-            logger.error(f"Attempt {attempt+1} embedding metadata failed: {e}")
-        time.sleep(1)
-    raise Exception("FFmpeg metadata embedding failed after multiple attempts.")
-
-def extract_spotify_id(url):
-    regex = r"open\.spotify\.com/(track|album|playlist)/([a-zA-Z0-9]+)"
-    match = re.search(regex, url)
-    if match:
-        return match.group(1), match.group(2)
-    return None, None
-
-def build_query(track):
-    artist = ", ".join([a["name"] for a in track.get("artists", [])])
-    title = track.get("name", "")
-    return f"{artist} - {title} official audio"
-
-def sanitize_filename(name):
-    return re.sub(r'[\\/*?:"<>|]', "", name)
-
-# -------------------------------
-# Cleanup functions for downloads folder
-# -------------------------------
-def cleanup_downloads():
-    downloads_dir = os.path.join(os.getcwd(), "downloads")
-    if os.path.exists(downloads_dir):
-        for filename in os.listdir(downloads_dir):
-            file_path = os.path.join(downloads_dir, filename)
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-            except Exception as e:
-                logger.error(f"Failed to delete {file_path}. Reason: {e}")
-
-def periodic_cleanup():
-    while True:
-        time.sleep(15 * 60)  # 15 minutes
-        cleanup_downloads()
-        logger.info("Periodic cleanup of downloads folder completed.")
-
-# Run cleanup on startup and start the periodic cleanup thread
-cleanup_downloads()
-threading.Thread(target=periodic_cleanup, daemon=True).start()
-
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
+import os
+import sys
+import argparse
+import re
+import logging
+import time
+import threading
+import shutil
+import zipfile
+from urllib.parse import quote
+import subprocess
+import uuid
+import sqlite3
+import hashlib
+import json
+import random
+import base64
+import struct
+import mimetypes
+import tempfile
+import socket
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, send_from_directory, jsonify, abort
+from jinja2 import DictLoader
+from werkzeug.security import safe_join
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("spotify_downloader")
+
+# Define FFmpeg binary path from the "ast" folder (adjust for Windows as needed)
+FFMPEG_BIN = os.path.join(os.getcwd(), "ast", "ffmpeg.exe")
+# Default thumbnail fallback from main directory
+DEFAULT_THUMB = os.path.join(os.getcwd(), "d.png")
+# Every job gets its own folder inside the downloads folder (shared by all hosts in worker mode)
+DOWNLOADS_DIR = os.environ.get("SSSSD_DOWNLOADS_DIR", os.path.join(os.getcwd(), "downloads"))
+# Job folders unused (no new files, not served) for this many seconds are removed
+DOWNLOADS_MAX_AGE = int(os.environ.get("SSSSD_DOWNLOADS_MAX_AGE", str(60 * 60)))
+# Least recently used job folders are removed once the downloads folder grows past this size
+DOWNLOADS_MAX_BYTES = int(os.environ.get("SSSSD_DOWNLOADS_MAX_BYTES", str(10 * 1024 ** 3)))
+# Job folders used within this many seconds are kept even when over the size limit
+DOWNLOADS_GRACE = 10 * 60
+# Seconds between two janitor runs (finished jobs also wake it up)
+JANITOR_INTERVAL = 60
+
+# Playlists downloaded in sync mode are kept here with their manifest, one folder per playlist
+# and options, so the next sync only downloads what changed (not touched by the cleanup)
+SYNC_DIR = os.environ.get("SSSSD_SYNC_DIR", os.path.join(os.getcwd(), "library"))
+# Finished tracks are kept here and reused by later jobs (not touched by the cleanup)
+TRACK_CACHE_DIR = os.path.join(os.getcwd(), "cache", "tracks")
+# Least recently used tracks are evicted once the cache grows past this size
+TRACK_CACHE_MAX_BYTES = int(os.environ.get("SSSSD_TRACK_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+# Album covers, stored once per image URL and shared by every track of the album
+ART_CACHE_DIR = os.path.join(os.getcwd(), "cache", "art")
+# Oldest covers are removed once there are more than this many
+ART_CACHE_MAX_FILES = 2000
+# Connect and read timeouts (seconds) for album cover downloads
+ART_TIMEOUT = (5, 20)
+# Spotify track -> YouTube video matches, so repeat tracks skip the YouTube search
+MATCH_DB_PATH = os.path.join(os.getcwd(), "cache", "matches.sqlite3")
+# How long (seconds) a match is trusted before the track is searched again
+MATCH_TTL = int(os.environ.get("SSSSD_MATCH_TTL", str(30 * 24 * 60 * 60)))
+
+
+
+
+#Paste your id and that here
+
+#------------------------------------
+
+SPOTIFY_CLIENT_ID = ""
+SPOTIFY_CLIENT_SECRET = ""
+
+#-------------------------------------
+
+
+
+# How long (seconds) Spotify track, album and playlist responses are reused
+SPOTIFY_CACHE_TTL = int(os.environ.get("SSSSD_SPOTIFY_CACHE_TTL", str(10 * 60)))
+# Maximum number of cached Spotify responses
+SPOTIFY_CACHE_SIZE = 256
+# Album and playlist pages fetched at the same time
+SPOTIFY_PAGE_WORKERS = int(os.environ.get("SSSSD_SPOTIFY_PAGE_WORKERS", "4"))
+
+# Attempts per track, and the backoff (seconds) between them, doubled on every retry
+RETRY_ATTEMPTS = int(os.environ.get("SSSSD_RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# Total time (seconds) a job may take; tracks still failing after that are given up
+JOB_TIME_BUDGET = int(os.environ.get("SSSSD_JOB_TIME_BUDGET", str(2 * 60 * 60)))
+# Search results compared against the Spotify track before one is downloaded
+SEARCH_CANDIDATES = int(os.environ.get("SSSSD_SEARCH_CANDIDATES", "5"))
+# Seconds without data before a YouTube connection is considered dead
+SOCKET_TIMEOUT = 30
+
+# Requests per second (and burst size) allowed to each upstream service
+YOUTUBE_RATE = float(os.environ.get("SSSSD_YOUTUBE_RATE", "3"))
+YOUTUBE_BURST = int(os.environ.get("SSSSD_YOUTUBE_BURST", "6"))
+SPOTIFY_RATE = float(os.environ.get("SSSSD_SPOTIFY_RATE", "5"))
+SPOTIFY_BURST = int(os.environ.get("SSSSD_SPOTIFY_BURST", "10"))
+# The circuit opens when at least CIRCUIT_FAILURE_RATIO of the calls in the last CIRCUIT_WINDOW
+# seconds failed (and there were at least CIRCUIT_MIN_CALLS), or right away on a 429.
+# Calls wait while it is open and one probe call is let through after CIRCUIT_COOLDOWN seconds.
+CIRCUIT_WINDOW = 60
+CIRCUIT_MIN_CALLS = 10
+CIRCUIT_FAILURE_RATIO = 0.5
+CIRCUIT_COOLDOWN = 30
+
+# Number of download jobs that run at the same time
+JOB_WORKERS = int(os.environ.get("SSSSD_JOB_WORKERS", "2"))
+# Jobs waiting for a worker before new submissions are refused
+MAX_QUEUED_JOBS = int(os.environ.get("SSSSD_MAX_QUEUED_JOBS", "50"))
+# Tracks whose audio is downloaded ahead while the current ones are encoded (0 turns it off)
+PREFETCH_TRACKS = int(os.environ.get("SSSSD_PREFETCH_TRACKS", "2"))
+# Disk space (bytes) the downloaded-ahead audio of a job may take while it waits to be encoded
+PREFETCH_MAX_BYTES = int(os.environ.get("SSSSD_PREFETCH_MAX_BYTES", str(256 * 1024 ** 2)))
+# Spotify URLs accepted in one batch (POST /batch or "python main.py batch")
+MAX_BATCH_URLS = int(os.environ.get("SSSSD_MAX_BATCH_URLS", "500"))
+# Seconds between two download progress events of the same track
+PROGRESS_INTERVAL = 0.5
+# How long (seconds) finished jobs can still be looked up on /jobs/<id>
+JOB_RETENTION = int(os.environ.get("SSSSD_JOB_RETENTION", str(60 * 60)))
+# Tracks of one album or playlist that are worked on at the same time
+TRACK_WORKERS = int(os.environ.get("SSSSD_TRACK_WORKERS", "4"))
+# YouTube searches and downloads running at the same time, across all jobs
+FETCH_CONCURRENCY = int(os.environ.get("SSSSD_FETCH_CONCURRENCY", "4"))
+# FFmpeg processes running at the same time, across all jobs
+FFMPEG_CONCURRENCY = int(os.environ.get("SSSSD_FFMPEG_CONCURRENCY", str(os.cpu_count() or 2)))
+
+# Shared job store (an SQLite file all hosts can reach). When set, the web process queues the
+# tracks of its jobs there and "python main.py worker" processes, on this or other hosts, run them.
+# DOWNLOADS_DIR then has to be on storage every worker writes to (SSSSD_DOWNLOADS_DIR).
+WORKER_STORE_PATH = os.environ.get("SSSSD_WORKER_STORE", "")
+# Seconds a worker may go without a heartbeat before its tracks are given to another worker
+WORKER_LEASE = 60
+# Seconds between two looks at the job store, for new tracks (workers) and progress (web process)
+WORKER_POLL_INTERVAL = 1.0
+
+# Address and request threads of the production server (progress and ZIP streams hold a thread each)
+SERVER_HOST = os.environ.get("SSSSD_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("SSSSD_PORT", "5000"))
+SERVER_THREADS = int(os.environ.get("SSSSD_SERVER_THREADS", "32"))
+# Behind nginx: internal location that maps to the downloads folder, files are then sent by
+# nginx through X-Accel-Redirect (e.g. "/protected-downloads/", see the README)
+ACCEL_REDIRECT_PREFIX = os.environ.get("SSSSD_ACCEL_REDIRECT", "")
+# Behind Apache (mod_xsendfile) or lighttpd: send files through the X-Sendfile header
+USE_X_SENDFILE = os.environ.get("SSSSD_X_SENDFILE", "") == "1"
+
+# Network-bound and CPU-bound steps are limited separately, so tracks waiting
+# on YouTube don't hold back tracks that are ready to be encoded (and the other way round).
+fetch_slots = threading.BoundedSemaphore(FETCH_CONCURRENCY)
+ffmpeg_slots = threading.BoundedSemaphore(FFMPEG_CONCURRENCY)
+
+# Routes are collected here and added to the app by create_app()
+routes = []
+
+def route(rule, **options):
+    def register(view):
+        routes.append((rule, view, options))
+        return view
+    return register
+
+# Define custom CSS style (no Bootstrap)
+custom_css = """
+<style>
+    html {
+        background:black;
+    }
+  body {
+      font-family: 'Helvetica Neue', Arial, sans-serif;
+      background: black;
+      color:white;
+      margin: 0;
+      padding: 0;
+      height:100%;
+      width:100%;
+  }
+  .navbar {
+      background-color: black;
+      color: #fff;
+      padding: 15px;
+      text-align: center;
+  }
+  .navbar h1 {
+      margin: 0;
+      font-size: 24px;
+  }
+  .container {
+      width: 90%;
+      max-width: 800px;
+      margin: 30px auto;
+      background-color: black;
+      box-shadow: 0 2px 8px rgba(0,0,0,0.1);
+      padding: 20px;
+      border-radius: 8px;
+  }
+  h2 {
+      color: white;
+      text-align: center;
+      margin-bottom: 20px;
+  }
+  form {
+    display:flex;
+    flex-direction:column;
+  }
+  form label {
+      font-weight: bold;
+      display: block;
+      margin-bottom: 5px;
+  }
+  form input[type="text"], form select {
+      padding: 10px;
+      border: 1px solid #ccc;
+      border-radius: 4px;
+      margin-bottom: 15px;
+      background:black;
+      color:white;
+  }
+  form button {
+      background-color: black;
+      color: white;
+      outline:1px solid white;
+      border: none;
+      padding: 8px 15px;
+      border-radius: 4px;
+      cursor: pointer;
+  }
+  form button:hover {
+      background-color: #0056b3;
+  }
+  .alert {
+      padding: 10px 15px;
+      margin-bottom: 20px;
+      border-radius: 4px;
+  }
+  .alert-info {
+      background-color: black;
+      color: white;
+  }
+  .alert-success {
+      background-color: black;
+      color: white;
+  }
+  .alert-danger {
+      background-color: black;
+      color: red;
+  }
+  a {
+      color: #007bff;
+      text-decoration: none;
+  }
+  a:hover {
+      text-decoration: underline;
+  }
+  .btn-secondary {
+      background-color: black;
+      color: white;
+      outline:1px solid white;
+      border: none;
+      padding: 8px 15px;
+      border-radius: 4px;
+      cursor: pointer;
+  }
+  .btn-secondary:hover {
+      background-color: #5a6268;
+  }
+  .progress {
+      width: 100%;
+      margin-bottom: 20px;
+      font-size: 14px;
+  }
+  .progress td {
+      padding: 2px 8px;
+  }
+</style>
+"""
+
+# Define HTML templates using custom CSS
+base_template = f"""
+<!doctype html>
+<html lang="en">
+  <head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <title>SilverSniper-SpotifyDownloader</title>
+    {custom_css}
+    {{% block head %}}{{% endblock %}}
+  </head>
+  <body>
+    <div class="navbar">
+      <h1>SilverSniper-SpotifyDownloader</h1>
+    </div>
+    <div class="container">
+      {{% with messages = get_flashed_messages() %}}
+        {{% if messages %}}
+          <div class="alert alert-info">
+            {{% for message in messages %}}
+              <div>{{{{ message }}}}</div>
+            {{% endfor %}}
+          </div>
+        {{% endif %}}
+      {{% endwith %}}
+      {{% block content %}}{{% endblock %}}
+    </div>
+  </body>
+</html>
+"""
+
+home_template = """
+{% extends "base.html" %}
+{% block content %}
+  <h2>Enter Spotify URL</h2>
+  <form method="post" action="{{ url_for('download') }}">
+    <label for="spotify_url">Spotify URL (track, album, or playlist):</label>
+    <input type="text" id="spotify_url" name="spotify_url" placeholder="https://open.spotify.com/track/..." required>
+
+    <label for="audio_format">Audio Format:</label>
+    <select id="audio_format" name="audio_format">
+      <option value="mp3" selected>MP3 (re-encoded)</option>
+      <option value="m4a">M4A / AAC (original audio, no re-encoding)</option>
+      <option value="opus">Opus (original audio, no re-encoding)</option>
+    </select>
+
+    <label for="sound_quality">Sound Quality (kbps, MP3 only):</label>
+    <select id="sound_quality" name="sound_quality">
+      <option value="64">64</option>
+      <option value="128">128</option>
+      <option value="192" selected>192</option>
+      <option value="320">320</option>
+    </select>
+
+    <!-- Dropdown for metadata options -->
+    <label for="metadata_options">Metadata Options:</label>
+    <select id="metadata_options" name="metadata_options">
+      <option value="all" selected>All (Title, Artist, Album, Date, Track Number, Disc Number, Thumbnail)</option>
+      <option value="basic">Basic (Title, Artist)</option>
+      <option value="minimal">Minimal (Title only)</option>
+      <option value="none">None</option>
+    </select>
+
+    <label for="playlist_order">Playlist Order:</label>
+    <select id="playlist_order" name="playlist_order">
+      <option value="as_is" selected>As Is</option>
+      <option value="reverse">Reverse</option>
+    </select>
+
+    <label for="sync_mode">Playlist Mode:</label>
+    <select id="sync_mode" name="sync_mode">
+      <option value="full" selected>Full download</option>
+      <option value="sync">Sync (only download what changed since the last sync)</option>
+    </select>
+
+    <button type="submit">Download</button>
+  </form>
+{% endblock %}
+"""
+
+result_template = """
+{% extends "base.html" %}
+{% block content %}
+  <h2>Download Results</h2>
+  {% if error %}
+    <div class="alert alert-danger">{{ error }}</div>
+  {% else %}
+    {% if zip_file %}
+      <div class="alert alert-success">Successfully created ZIP archive:</div>
+      <ul>
+        <li><a href="{{ url_for('job_zip', job_id=job_id) }}">{{ zip_file }}</a></li>
+      </ul>
+    {% else %}
+      <div class="alert alert-success">Successfully downloaded the file:</div>
+      <ul>
+        {% for file in files %}
+          <li><a href="{{ url_for('downloaded_file', filename=file) }}">{{ file.split('/')[-1] }}</a></li>
+        {% endfor %}
+      </ul>
+    {% endif %}
+  {% endif %}
+  <a class="btn-secondary" href="{{ url_for('home') }}">Back</a>
+{% endblock %}
+"""
+
+job_template = """
+{% extends "base.html" %}
+{% block head %}<noscript><meta http-equiv="refresh" content="3"></noscript>{% endblock %}
+{% block content %}
+  <h2>Download in progress</h2>
+  <div class="alert alert-info">
+    Job {{ job.id }} is <span id="job-status">{{ job.status }}</span>.
+    {% if job.queue_position %}Position in queue: {{ job.queue_position }}.{% endif %}
+    This page updates automatically.
+  </div>
+  {% if job.zip_file %}
+    <ul>
+      <li>
+        <a href="{{ url_for('job_zip', job_id=job.id) }}">{{ job.zip_file }}</a>
+        ({{ job.entries|length }} tracks ready, the rest is added to the ZIP while it downloads)
+      </li>
+    </ul>
+  {% endif %}
+  <table class="progress"><tbody id="tracks"></tbody></table>
+  <a class="btn-secondary" href="{{ url_for('home') }}">Back</a>
+  <script>
+    var rows = {};
+    function describe(ev) {
+      var text = ev.stage;
+      if (ev.stage === "download" && ev.total_bytes) {
+        text += " " + Math.round(100 * ev.downloaded_bytes / ev.total_bytes) + "%";
+      }
+      if (ev.speed) { text += " " + (ev.speed / 1048576).toFixed(1) + " MB/s"; }
+      if (ev.eta) { text += ", ETA " + ev.eta + "s"; }
+      return text;
+    }
+    var source = new EventSource("{{ url_for('job_events', job_id=job.id) }}");
+    source.addEventListener("track", function (e) {
+      var ev = JSON.parse(e.data);
+      var row = rows[ev.position];
+      if (!row) {
+        row = rows[ev.position] = document.createElement("tr");
+        row.appendChild(document.createElement("td")).textContent = ev.position + ". " + ev.name;
+        row.appendChild(document.createElement("td"));
+        var tbody = document.getElementById("tracks");
+        var next = Array.prototype.find.call(tbody.children, function (r) { return r.position > ev.position; });
+        row.position = ev.position;
+        tbody.insertBefore(row, next || null);
+      }
+      row.lastChild.textContent = describe(ev);
+    });
+    source.addEventListener("job", function (e) {
+      var ev = JSON.parse(e.data);
+      document.getElementById("job-status").textContent = ev.status;
+      if (ev.status === "done" || ev.status === "failed") {
+        source.close();
+        location.reload();
+      }
+    });
+  </script>
+{% endblock %}
+"""
+
+def create_app():
+    """
+    Builds the Flask app and starts the janitor. Importing this module does no work of its own,
+    and the download stack (spotipy, yt-dlp, requests) is only imported once a job needs it,
+    so the server, workers and the batch CLI start quickly.
+    """
+    flask_app = Flask(__name__)
+    flask_app.secret_key = 'supersecretkey'
+    flask_app.config["USE_X_SENDFILE"] = USE_X_SENDFILE
+    # Set up a Jinja2 DictLoader with our templates
+    flask_app.jinja_loader = DictLoader({
+        "base.html": base_template,
+        "home.html": home_template,
+        "result.html": result_template,
+        "job.html": job_template,
+    })
+    for rule, view, options in routes:
+        flask_app.add_url_rule(rule, view_func=view, **options)
+    start_janitor()
+    return flask_app
+
+# Which tags get embedded for each entry of the "Metadata Options" dropdown
+METADATA_PROFILES = {
+    "all": dict(include_title=True, include_artist=True, include_album=True, include_date=True,
+                include_track=True, include_disc=True, include_thumbnail=True),
+    "basic": dict(include_title=True, include_artist=True, include_album=False, include_date=False,
+                  include_track=False, include_disc=False, include_thumbnail=False),
+    "minimal": dict(include_title=True, include_artist=False, include_album=False, include_date=False,
+                    include_track=False, include_disc=False, include_thumbnail=False),
+    "none": dict(include_title=False, include_artist=False, include_album=False, include_date=False,
+                 include_track=False, include_disc=False, include_thumbnail=False),
+}
+
+def metadata_flags(metadata_option):
+    # Unknown options fall back to embedding everything
+    return dict(METADATA_PROFILES.get(metadata_option, METADATA_PROFILES["all"]))
+
+# Output formats: which YouTube stream to fetch, and the encoder used when it can't be copied.
+# M4A and Opus keep YouTube's audio as is (only remuxed and tagged), which costs almost no CPU.
+# Only MP3 is always re-encoded.
+AUDIO_FORMATS = {
+    "mp3": dict(ext="mp3", stream="bestaudio/best", copy=False,
+                codec=["-codec:a", "libmp3lame", "-id3v2_version", "3"]),
+    "m4a": dict(ext="m4a", stream="bestaudio[ext=m4a]/bestaudio[acodec^=mp4a]/bestaudio/best", copy=True,
+                codec=["-codec:a", "aac"]),
+    "opus": dict(ext="opus", stream="bestaudio[acodec=opus]/bestaudio/best", copy=True,
+                 codec=["-codec:a", "libopus"]),
+}
+
+def audio_format_name(audio_format):
+    # Unknown formats fall back to MP3
+    return audio_format if audio_format in AUDIO_FORMATS else "mp3"
+
+# -------------------------------
+# Spotify client
+# -------------------------------
+spotify_client = None
+spotify_client_lock = threading.Lock()
+spotify_cache = {}
+spotify_cache_lock = threading.Lock()
+spotify_fetch_locks = {}
+
+def get_spotify_client():
+    """
+    Returns the process-wide Spotify client. Its access token and pooled HTTP connections
+    are reused by every job instead of doing a fresh token exchange per request.
+    """
+    global spotify_client
+    with spotify_client_lock:
+        if spotify_client is None:
+            import requests
+            import spotipy
+            from spotipy.oauth2 import SpotifyClientCredentials
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(JOB_WORKERS, 10))
+            session.mount("https://", adapter)
+            auth_manager = SpotifyClientCredentials(client_id=SPOTIFY_CLIENT_ID,
+                                                    client_secret=SPOTIFY_CLIENT_SECRET)
+            spotify_client = spotipy.Spotify(auth_manager=auth_manager, requests_session=session,
+                                              requests_timeout=10)
+        return spotify_client
+
+def spotify_cached(kind, spotify_id, fetch, *args):
+    """
+    Returns fetch(spotify_id, *args), reusing the response for SPOTIFY_CACHE_TTL seconds.
+    Concurrent requests for the same item wait for one API call instead of each making their own.
+    """
+    key = (kind, spotify_id) + args
+    with spotify_cache_lock:
+        fetch_lock = spotify_fetch_locks.setdefault(key, threading.Lock())
+    with fetch_lock:
+        with spotify_cache_lock:
+            cached = spotify_cache.get(key)
+            if cached and cached[0] > time.time():
+                count_metric("ssssd_cache_hits_total", cache="spotify")
+                return cached[1]
+        count_metric("ssssd_cache_misses_total", cache="spotify")
+        with upstream_call("spotify"), timed_stage("spotify_fetch"):
+            response = fetch(spotify_id, *args)
+        with spotify_cache_lock:
+            now = time.time()
+            for stale in [k for k, (expires, _) in spotify_cache.items() if expires <= now]:
+                del spotify_cache[stale]
+            while len(spotify_cache) >= SPOTIFY_CACHE_SIZE:
+                del spotify_cache[min(spotify_cache, key=lambda k: spotify_cache[k][0])]
+            spotify_cache[key] = (now + SPOTIFY_CACHE_TTL, response)
+            spotify_fetch_locks.pop(key, None)
+        return response
+
+def forget_spotify_cache(spotify_id):
+    """Drops every cached response about the item, e.g. a playlist that changed."""
+    with spotify_cache_lock:
+        for key in [k for k in spotify_cache if k[1] == spotify_id]:
+            del spotify_cache[key]
+
+spotify_page_executor = ThreadPoolExecutor(max_workers=SPOTIFY_PAGE_WORKERS, thread_name_prefix="ssssd-spotify")
+
+class SpotifyTrackList:
+    """
+    Lazily iterates over every track of an album or playlist, in order.
+    The first page comes with the album or playlist itself. Once it tells the total count,
+    the remaining pages are fetched concurrently in the background, so the first tracks can
+    be downloaded before the whole listing has arrived. len() is the total reported by Spotify.
+    """
+    def __init__(self, first_page, fetch_page, convert):
+        self.first_items = first_page.get("items", [])
+        self.total = first_page.get("total", len(self.first_items))
+        self.convert = convert
+        page_size = first_page.get("limit") or len(self.first_items) or 1
+        self.pages = []
+        if first_page.get("next"):
+            self.pages = [spotify_page_executor.submit(fetch_page, offset, page_size)
+                          for offset in range(len(self.first_items), self.total, page_size)]
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        for item in self.first_items:
+            track = self.convert(item)
+            if track:
+                yield track
+        for page in self.pages:
+            for item in page.result().get("items", []):
+                track = self.convert(item)
+                if track:
+                    yield track
+
+def get_items_from_spotify(sp, url_type, spotify_id):
+    if url_type == "track":
+        track = spotify_cached("track", spotify_id, sp.track)
+        return [track], track.get("name", "Track")
+    elif url_type == "album":
+        album = spotify_cached("album", spotify_id, sp.album)
+        # Album track items don't carry the album itself, attach it so they get the same
+        # album tags and cover art as tracks coming from a playlist or a track URL.
+        album_info = {k: v for k, v in album.items() if k != "tracks"}
+        def convert(track):
+            track.setdefault("album", album_info)
+            return track
+        def fetch_page(offset, limit):
+            return spotify_cached("album_tracks", spotify_id, lambda i, o, l: sp.album_tracks(i, limit=l, offset=o),
+                                  offset, limit)
+        return SpotifyTrackList(album.get("tracks", {}), fetch_page, convert), album.get("name", "Album")
+    elif url_type == "playlist":
+        playlist = spotify_cached("playlist", spotify_id, sp.playlist)
+        # Playlist items usually wrap the track info inside a "track" key.
+        def convert(item):
+            return item.get("track")
+        def fetch_page(offset, limit):
+            return spotify_cached("playlist_items", spotify_id,
+                                  lambda i, o, l: sp.playlist_items(i, limit=l, offset=o, additional_types=("track",)),
+                                  offset, limit)
+        return SpotifyTrackList(playlist.get("tracks", {}), fetch_page, convert), playlist.get("name", "Playlist")
+    else:
+        raise ValueError("Invalid Spotify URL type.")
+
+@route("/")
+def home():
+    return render_template("home.html")
+
+# -------------------------------
+# Metrics
+# -------------------------------
+# Stage timings, counters and gauges, exposed in the Prometheus text format on /metrics.
+# Upper bounds (seconds) of the stage timing histogram buckets
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+METRIC_HELP = {
+    "ssssd_stage_seconds": ("histogram", "Time spent in each pipeline stage."),
+    "ssssd_retries_total": ("counter", "Retried attempts by stage."),
+    "ssssd_failures_total": ("counter", "Failed attempts by stage."),
+    "ssssd_cache_hits_total": ("counter", "Cache lookups that found an entry, by cache."),
+    "ssssd_cache_misses_total": ("counter", "Cache lookups that found nothing, by cache."),
+    "ssssd_jobs_total": ("counter", "Finished jobs by status."),
+    "ssssd_throttled_total": ("counter", "Calls rejected with 429 / rate limit errors, by upstream."),
+    "ssssd_circuit_trips_total": ("counter", "Times the circuit breaker opened, by upstream."),
+    "ssssd_evicted_jobs_total": ("counter", "Job folders removed by the janitor, by reason (age or quota)."),
+    "ssssd_prefetch_total": ("counter", "Tracks downloaded ahead, by outcome (used, failed or discarded)."),
+}
+metrics_lock = threading.Lock()
+# stage -> [count per bucket..., count above the last bucket, sum, count]
+stage_histograms = {}
+# (name, sorted labels) -> value
+metric_counters = {}
+# pool -> number of threads holding / waiting for a slot of that pool
+active_workers = {"track": 0, "fetch": 0, "ffmpeg": 0}
+waiting_workers = {"fetch": 0, "ffmpeg": 0}
+
+def observe_stage(stage, seconds):
+    with metrics_lock:
+        histogram = stage_histograms.setdefault(stage, [0] * (len(STAGE_BUCKETS) + 3))
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(STAGE_BUCKETS)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def count_metric(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metric_counters[key] = metric_counters.get(key, 0) + amount
+
+@contextmanager
+def worker_slot(slots, pool):
+    """Acquires a slot of the fetch or FFmpeg pool and keeps the busy/waiting gauges up to date."""
+    with metrics_lock:
+        waiting_workers[pool] += 1
+    try:
+        slots.acquire()
+    finally:
+        with metrics_lock:
+            waiting_workers[pool] -= 1
+    with metrics_lock:
+        active_workers[pool] += 1
+    try:
+        yield
+    finally:
+        with metrics_lock:
+            active_workers[pool] -= 1
+        slots.release()
+
+def format_labels(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+def render_metrics():
+    lines = []
+    with metrics_lock:
+        lines.append(f"# HELP ssssd_stage_seconds {METRIC_HELP['ssssd_stage_seconds'][1]}")
+        lines.append("# TYPE ssssd_stage_seconds histogram")
+        for stage, histogram in sorted(stage_histograms.items()):
+            cumulative = 0
+            for bound, value in zip(STAGE_BUCKETS + ("+Inf",), histogram):
+                cumulative += value
+                lines.append(f'ssssd_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'ssssd_stage_seconds_sum{{stage="{stage}"}} {histogram[-2]}')
+            lines.append(f'ssssd_stage_seconds_count{{stage="{stage}"}} {histogram[-1]}')
+        for name, (kind, help_text) in METRIC_HELP.items():
+            if kind != "counter":
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(metric_counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        lines.append("# HELP ssssd_active_workers Threads currently working, by pool.")
+        lines.append("# TYPE ssssd_active_workers gauge")
+        for pool, value in sorted(active_workers.items()):
+            lines.append(f'ssssd_active_workers{{pool="{pool}"}} {value}')
+        lines.append("# HELP ssssd_waiting_workers Threads waiting for a slot, by pool.")
+        lines.append("# TYPE ssssd_waiting_workers gauge")
+        for pool, value in sorted(waiting_workers.items()):
+            lines.append(f'ssssd_waiting_workers{{pool="{pool}"}} {value}')
+    lines.append("# HELP ssssd_circuit_open Whether calls to the upstream are paused (1) or not (0).")
+    lines.append("# TYPE ssssd_circuit_open gauge")
+    for name, breaker in sorted(circuit_breakers.items()):
+        lines.append(f'ssssd_circuit_open{{upstream="{name}"}} {0 if breaker.state == "closed" else 1}')
+    with jobs_lock:
+        statuses = [job["status"] for job in jobs.values()]
+    lines.append("# HELP ssssd_jobs Known jobs by status (queue depth is status=\"queued\").")
+    lines.append("# TYPE ssssd_jobs gauge")
+    for status in ("queued", "running", "done", "failed"):
+        lines.append(f'ssssd_jobs{{status="{status}"}} {statuses.count(status)}')
+    lines.append("# HELP ssssd_downloads_bytes Size of the downloads folder at the last janitor run.")
+    lines.append("# TYPE ssssd_downloads_bytes gauge")
+    lines.append(f"ssssd_downloads_bytes {downloads_bytes}")
+    lines.append("# HELP ssssd_job_workers Size of the job worker pool.")
+    lines.append("# TYPE ssssd_job_workers gauge")
+    lines.append(f"ssssd_job_workers {JOB_WORKERS}")
+    return "\n".join(lines) + "\n"
+
+@route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+# -------------------------------
+# Retries
+# -------------------------------
+class PermanentError(Exception):
+    """A failure that trying again won't fix, e.g. a search without results."""
+
+class TimeBudgetExceeded(Exception):
+    """The job ran out of time before the work could be (re)tried."""
+
+class EncodeError(Exception):
+    """FFmpeg failed to convert a track. Worth retrying, its stderr says nothing about the video."""
+
+# Error messages from yt-dlp that mean the video can't be downloaded, no matter how often we try
+PERMANENT_ERROR_MARKERS = (
+    "video unavailable",
+    "private video",
+    "this video has been removed",
+    "sign in to confirm your age",
+    "not available in your country",
+    "members-only",
+    "unsupported url",
+    "blocked it on copyright grounds",
+)
+
+def is_permanent_error(error):
+    if isinstance(error, (PermanentError, TimeBudgetExceeded)):
+        return True
+    # FFmpeg's stderr (banner included) must not be matched against the yt-dlp messages
+    if isinstance(error, EncodeError):
+        return False
+    message = str(error).lower()
+    return any(marker in message for marker in PERMANENT_ERROR_MARKERS)
+
+def retry_delay(attempt):
+    """Exponential backoff with jitter, so retries of many tracks don't hit YouTube at the same moment."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def call_with_retry(fn, stage, deadline=None, attempts=RETRY_ATTEMPTS):
+    """
+    Calls fn(attempt) until it succeeds. Permanent errors are raised right away, transient ones
+    are retried with backoff up to 'attempts' times, as long as the retry fits before the deadline.
+    """
+    for attempt in range(attempts):
+        if deadline is not None and time.time() >= deadline:
+            raise TimeBudgetExceeded("The job's time budget was used up.")
+        try:
+            return fn(attempt)
+        except Exception as e:
+            permanent = is_permanent_error(e)
+            count_metric("ssssd_failures_total", stage=stage, kind="permanent" if permanent else "transient")
+            if permanent or attempt + 1 >= attempts:
+                raise
+            delay = retry_delay(attempt)
+            if deadline is not None and time.time() + delay >= deadline:
+                raise
+            count_metric("ssssd_retries_total", stage=stage)
+            logger.warning(f"{stage} attempt {attempt+1} failed, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+def wait_until(future, deadline):
+    """Returns the future's result, or raises TimeBudgetExceeded if it isn't there by the deadline."""
+    try:
+        return future.result(timeout=max(0, deadline - time.time()))
+    except FutureTimeoutError:
+        raise TimeBudgetExceeded("The job's time budget was used up while waiting.") from None
+
+# -------------------------------
+# Upstream rate limiting
+# -------------------------------
+class TokenBucket:
+    """Lets through 'rate' calls per second on average, with bursts of up to 'burst' calls."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class CircuitBreaker:
+    """
+    Stops calls to an upstream whose error rate spiked. While open, callers wait instead of
+    failing, so the work is paused and resumes by itself once a probe call succeeds.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.state = "closed"
+        self.opened_at = 0
+        self.probing = False
+        self.outcomes = []
+        self.condition = threading.Condition()
+
+    def wait(self):
+        """Returns True if the caller's call is the probe, which has to pass probe=True to record()."""
+        with self.condition:
+            while True:
+                if self.state == "closed":
+                    return False
+                if self.state == "open" and time.monotonic() - self.opened_at >= CIRCUIT_COOLDOWN:
+                    self.state = "half_open"
+                if self.state == "half_open" and not self.probing:
+                    self.probing = True
+                    return True
+                self.condition.wait(timeout=1)
+
+    def record(self, success, throttled=False, probe=False):
+        with self.condition:
+            now = time.monotonic()
+            if self.state == "half_open":
+                # Calls that started before the circuit opened say nothing about its recovery
+                if not probe:
+                    return
+                self.probing = False
+                if success:
+                    logger.info(f"{self.name} circuit closed")
+                    self.state = "closed"
+                    self.outcomes = []
+                else:
+                    self.trip(now)
+                self.condition.notify_all()
+                return
+            self.outcomes.append((now, success))
+            self.outcomes = [(t, ok) for t, ok in self.outcomes if now - t <= CIRCUIT_WINDOW]
+            failures = sum(1 for _, ok in self.outcomes if not ok)
+            if self.state == "closed" and (throttled or (len(self.outcomes) >= CIRCUIT_MIN_CALLS
+                                                         and failures >= CIRCUIT_FAILURE_RATIO * len(self.outcomes))):
+                self.trip(now)
+
+    def trip(self, now):
+        logger.warning(f"{self.name} circuit opened, pausing calls for {CIRCUIT_COOLDOWN}s")
+        count_metric("ssssd_circuit_trips_total", upstream=self.name)
+        self.state = "open"
+        self.opened_at = now
+
+rate_limiters = {
+    "youtube": TokenBucket(YOUTUBE_RATE, YOUTUBE_BURST),
+    "spotify": TokenBucket(SPOTIFY_RATE, SPOTIFY_BURST),
+}
+circuit_breakers = {name: CircuitBreaker(name) for name in rate_limiters}
+
+# yt-dlp messages for throttled requests (a bare "429" could be part of an ID or URL)
+THROTTLED_ERROR_MARKERS = ("http error 429", "too many requests", "rate-limited by youtube")
+
+def is_throttled_error(error):
+    # SpotifyException carries the HTTP status
+    if getattr(error, "http_status", None) == 429:
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in THROTTLED_ERROR_MARKERS)
+
+@contextmanager
+def upstream_call(name):
+    """
+    Wraps one call to YouTube or Spotify: waits while the circuit is open, takes a token from
+    the rate limiter and records the outcome. Permanent errors (no results, removed video)
+    say nothing about the health of the upstream and count as successes.
+    """
+    breaker = circuit_breakers[name]
+    probe = breaker.wait()
+    rate_limiters[name].acquire()
+    try:
+        yield
+    except Exception as e:
+        throttled = is_throttled_error(e)
+        if throttled:
+            count_metric("ssssd_throttled_total", upstream=name)
+        breaker.record(is_permanent_error(e) and not throttled, throttled=throttled, probe=probe)
+        raise
+    except BaseException:
+        # The caller went away (e.g. generator closed); don't leave a half-open probe hanging
+        breaker.record(True, probe=probe)
+        raise
+    else:
+        breaker.record(True, probe=probe)
+
+# -------------------------------
+# Job queue
+# -------------------------------
+# Downloads run on a bounded worker pool so the web requests return right away.
+jobs = {}
+jobs_lock = threading.Condition()
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="ssssd-job")
+
+def create_job(options):
+    job_id = uuid.uuid4().hex
+    job = {
+        "id": job_id,
+        "status": "queued",
+        "options": options,
+        "created": time.time(),
+        "started": None,
+        "finished": None,
+        "files": None,
+        "zip_file": None,
+        "error": None,
+        # (name in the ZIP, path) of the finished tracks of a collection, in completion order
+        "entries": [],
+        # Progress events for /jobs/<id>/events, and the latest state of every track by position
+        "events": [],
+        "tracks": {},
+    }
+    with jobs_lock:
+        jobs[job_id] = job
+    return job_id
+
+def get_job(job_id):
+    """Return a snapshot of the job, or None if it is unknown or has expired."""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return None
+        snapshot = dict(job)
+        snapshot["entries"] = list(job["entries"])
+        snapshot["tracks"] = [dict(job["tracks"][position]) for position in sorted(job["tracks"])]
+        if job["status"] == "queued":
+            queued = sorted((j["created"], j["id"]) for j in jobs.values() if j["status"] == "queued")
+            snapshot["queue_position"] = queued.index((job["created"], job_id)) + 1
+        else:
+            snapshot["queue_position"] = None
+        return snapshot
+
+def update_job(job_id, **fields):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+            jobs_lock.notify_all()
+
+def add_job_entry(job_id, arcname, path):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            job["entries"].append((arcname, path))
+            jobs_lock.notify_all()
+
+def iter_job_entries(job_id):
+    """Yields the finished tracks of a job as they complete, until the job is over."""
+    sent = 0
+    while True:
+        with jobs_lock:
+            job = jobs.get(job_id)
+            if job is None:
+                return
+            while len(job["entries"]) <= sent and job["status"] in ("queued", "running"):
+                jobs_lock.wait(timeout=30)
+            new_entries = job["entries"][sent:]
+            finished = job["status"] not in ("queued", "running")
+        for entry in new_entries:
+            yield entry
+        sent += len(new_entries)
+        if finished and not new_entries:
+            return
+
+def add_job_event(job_id, **event):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            event["seq"] = len(job["events"]) + 1
+            event["time"] = time.time()
+            job["events"].append(event)
+            jobs_lock.notify_all()
+
+def report_track_progress(job_id, position, name, stage, **info):
+    """
+    Records the current step of a track (queued, search, download, encode, cached, done, failed)
+    and publishes it as a progress event. Download progress is sent at most every PROGRESS_INTERVAL.
+    """
+    now = time.time()
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return
+        state = job["tracks"].setdefault(position, {"position": position, "name": name})
+        throttled = (stage == "download" and state.get("stage") == "download"
+                     and now - state["updated"] < PROGRESS_INTERVAL)
+        state.update(info)
+        if throttled:
+            return
+        state.update(stage=stage, updated=now)
+        add_job_event(job_id, type="track", position=position, name=name, stage=stage, **info)
+
+def iter_job_events(job_id, last_seq=0):
+    """Yields the job's progress events after last_seq as server-sent events, until the job is over."""
+    while True:
+        with jobs_lock:
+            job = jobs.get(job_id)
+            if job is None:
+                return
+            jobs_lock.wait_for(lambda: len(job["events"]) > last_seq
+                               or job["status"] not in ("queued", "running"), timeout=15)
+            new_events = job["events"][last_seq:]
+            finished = job["status"] not in ("queued", "running")
+        if not new_events:
+            if finished:
+                return
+            # Keeps proxies from closing an idle connection
+            yield ": keep-alive\n\n"
+            continue
+        for event in new_events:
+            yield f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        last_seq = new_events[-1]["seq"]
+
+def count_queued_jobs():
+    with jobs_lock:
+        return sum(1 for j in jobs.values() if j["status"] == "queued")
+
+def job_key(options):
+    """Jobs with the same key produce the same files."""
+    order = options.get("playlist_order", "as_is") if options["url_type"] in ("playlist", "batch") else "as_is"
+    profile = options["metadata_option"] if options["metadata_option"] in METADATA_PROFILES else "all"
+    audio_format = audio_format_name(options.get("audio_format"))
+    # The bitrate only matters for formats that get re-encoded
+    quality = options["sound_quality"] if not AUDIO_FORMATS[audio_format]["copy"] else None
+    # Sync jobs also update the playlist's manifest, so they don't share a plain download's job
+    return (options["url_type"], options["spotify_id"], audio_format, quality, profile, order,
+            bool(options.get("sync")))
+
+def submit_job(options):
+    """
+    Queue a download job. Returns the job ID, or None if the queue is full.
+    If the same collection with the same options is already queued or running,
+    the existing job is returned so both requesters share its result.
+    """
+    key = job_key(options)
+    with jobs_lock:
+        for job in jobs.values():
+            if job["status"] in ("queued", "running") and job_key(job["options"]) == key:
+                logger.info(f"Attaching request for {options['spotify_url']} to running job {job['id']}")
+                return job["id"]
+        if count_queued_jobs() >= MAX_QUEUED_JOBS:
+            return None
+        job_id = create_job(options)
+    job_executor.submit(run_job, job_id)
+    return job_id
+
+def run_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return
+    update_job(job_id, status="running", started=time.time())
+    add_job_event(job_id, type="job", status="running")
+    try:
+        result = run_download(job_id, job["options"])
+    except Exception as e:
+        logger.exception(f"Job {job_id} crashed")
+        result = {"files": None, "zip_file": None, "error": f"Download failed: {e}"}
+    status = "failed" if result.get("error") else "done"
+    update_job(job_id, status=status, finished=time.time(), **result)
+    count_metric("ssssd_jobs_total", status=status)
+    add_job_event(job_id, type="job", status=status, error=result.get("error"))
+    logger.info(f"Job {job_id} {status}")
+    # New files may have pushed the downloads folder over its size limit
+    janitor_wakeup.set()
+
+def prune_jobs():
+    """Forget finished jobs older than JOB_RETENTION."""
+    cutoff = time.time() - JOB_RETENTION
+    with jobs_lock:
+        for job_id in [j["id"] for j in jobs.values() if j["finished"] and j["finished"] < cutoff]:
+            del jobs[job_id]
+
+def wants_json():
+    # API clients ask for JSON, browsers get HTML pages and redirects
+    return request.accept_mimetypes.best_match(["text/html", "application/json"]) == "application/json"
+
+@route("/download", methods=["POST"])
+def download():
+    spotify_url = request.form.get("spotify_url", "").strip()
+    if not spotify_url:
+        if wants_json():
+            return jsonify(error="Please provide a Spotify URL."), 400
+        flash("Please provide a Spotify URL.")
+        return redirect(url_for("home"))
+    
+    url_type, spotify_id = extract_spotify_id(spotify_url)
+    if not url_type or not spotify_id:
+        error = "Invalid Spotify URL."
+        if wants_json():
+            return jsonify(error=error), 400
+        return render_template("result.html", error=error, files=None, zip_file=None)
+    
+    # Retrieve extra options from the form
+    options = {
+        "spotify_url": spotify_url,
+        "url_type": url_type,
+        "spotify_id": spotify_id,
+        "sound_quality": request.form.get("sound_quality", "192"),
+        "playlist_order": request.form.get("playlist_order", "as_is"),
+        "metadata_option": request.form.get("metadata_options", "all"),
+        "audio_format": audio_format_name(request.form.get("audio_format", "mp3")),
+        "sync": url_type == "playlist" and request.form.get("sync_mode") == "sync",
+    }
+    job_id = submit_job(options)
+    if job_id is None:
+        error = "The server is busy, please try again in a few minutes."
+        if wants_json():
+            return jsonify(error=error), 503
+        flash(error)
+        return redirect(url_for("home"))
+    
+    logger.info(f"Queued job {job_id} for {spotify_url}")
+    if wants_json():
+        return jsonify(job_id=job_id,
+                       status_url=url_for("job_status", job_id=job_id),
+                       result_url=url_for("job_result", job_id=job_id)), 202
+    return redirect(url_for("job_result", job_id=job_id))
+
+def batch_options(urls, form):
+    """
+    Returns the job options for a batch of Spotify URLs (None if there are no valid ones) and
+    the URLs that aren't. The same set of URLs gives the same spotify_id, so repeats share a job.
+    """
+    parsed = []
+    invalid = []
+    for url in urls:
+        url_type, spotify_id = extract_spotify_id(url.strip()) if isinstance(url, str) else (None, None)
+        if not url_type:
+            invalid.append(url)
+        elif [url_type, spotify_id] not in parsed:
+            parsed.append([url_type, spotify_id])
+    if not parsed:
+        return None, invalid
+    options = {
+        "spotify_url": f"{len(parsed)} Spotify URLs",
+        "url_type": "batch",
+        "spotify_id": hashlib.sha1(json.dumps(sorted(parsed)).encode("utf-8")).hexdigest(),
+        "urls": parsed,
+        "sound_quality": str(form.get("sound_quality", "192")),
+        "playlist_order": form.get("playlist_order", "as_is"),
+        "metadata_option": form.get("metadata_options", "all"),
+        "audio_format": audio_format_name(form.get("audio_format", "mp3")),
+    }
+    return options, invalid
+
+@route("/batch", methods=["POST"])
+def batch():
+    """
+    Queues one job for many Spotify URLs, e.g. for library syncs:
+    {"urls": [...], "audio_format": "mp3", "sound_quality": "192", "metadata_options": "all",
+     "playlist_order": "as_is"}. Tracks in several of the albums and playlists are downloaded once.
+    The result is one ZIP with a folder per album or playlist (single tracks go to "Tracks").
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("urls"), list) or not body["urls"]:
+        return jsonify(error="Expected a JSON object with a list of Spotify URLs in 'urls'."), 400
+    if len(body["urls"]) > MAX_BATCH_URLS:
+        return jsonify(error=f"At most {MAX_BATCH_URLS} URLs per batch."), 400
+    options, invalid = batch_options(body["urls"], body)
+    if invalid:
+        return jsonify(error="Invalid Spotify URLs.", invalid=invalid), 400
+    job_id = submit_job(options)
+    if job_id is None:
+        return jsonify(error="The server is busy, please try again in a few minutes."), 503
+    logger.info(f"Queued batch job {job_id} for {options['spotify_url']}")
+    return jsonify(job_id=job_id,
+                   urls=len(options["urls"]),
+                   status_url=url_for("job_status", job_id=job_id),
+                   result_url=url_for("job_result", job_id=job_id)), 202
+
+@route("/jobs/<job_id>")
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify(error="Unknown job."), 404
+    return jsonify(
+        id=job["id"],
+        status=job["status"],
+        queue_position=job["queue_position"],
+        created=job["created"],
+        started=job["started"],
+        finished=job["finished"],
+        error=job["error"],
+        files=[url_for("downloaded_file", filename=f) for f in job["files"] or []],
+        zip_file=url_for("job_zip", job_id=job_id) if job["zip_file"] else None,
+        tracks_ready=len(job["entries"]),
+        tracks=job["tracks"],
+    )
+
+@route("/jobs/<job_id>/result")
+def job_result(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return render_template("result.html", error="Unknown or expired job.", files=None, zip_file=None), 404
+    if job["status"] in ("queued", "running"):
+        return render_template("job.html", job=job)
+    return render_template("result.html", error=job["error"], files=job["files"], zip_file=job["zip_file"],
+                           job_id=job_id)
+
+@route("/jobs/<job_id>/events")
+def job_events(job_id):
+    """
+    Server-sent event stream of the job's progress: the status of the job and, for every track,
+    the current step with bytes, speed and ETA while downloading. Reconnects resume after Last-Event-ID.
+    """
+    if get_job(job_id) is None:
+        return jsonify(error="Unknown job."), 404
+    try:
+        last_seq = int(request.headers.get("Last-Event-ID", request.args.get("after", "0")))
+    except ValueError:
+        last_seq = 0
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(iter_job_events(job_id, last_seq), mimetype="text/event-stream", headers=headers)
+
+@route("/jobs/<job_id>/zip")
+def job_zip(job_id):
+    """
+    Streams the collection as a ZIP archive. Tracks are added as soon as they are finished,
+    so the download can start while the rest of the job is still running.
+    Once the job is done the archive is kept in the job's folder the first time it is sent,
+    and served as a file from then on (with Range requests and sendfile).
+    """
+    job = get_job(job_id)
+    if job is None or not job["zip_file"] or not begin_transfer(job_id):
+        return render_template("result.html", error="Unknown or expired job.", files=None, zip_file=None), 404
+    try:
+        zip_path = os.path.join(DOWNLOADS_DIR, job_id, job["zip_file"])
+        if job["status"] == "done" and os.path.isfile(zip_path):
+            response = send_download(f"{job_id}/{job['zip_file']}", as_attachment=True)
+        else:
+            body = iter_job_entries(job_id)
+            body = stream_and_keep_zip(body, zip_path) if job["status"] == "done" else stream_zip(body)
+            headers = {"Content-Disposition": f"attachment; filename*=UTF-8''{quote(job['zip_file'])}"}
+            response = Response(body, mimetype="application/zip", headers=headers)
+    except Exception:
+        end_transfer(job_id)
+        raise
+    return end_transfer_on_close(response, job_id)
+
+def fetch_track_source(track, folder, file_stem, audio_format, progress):
+    """Downloads the track's audio from YouTube, see download_song. Returns the source file."""
+    return download_song(build_query(track), folder, file_stem, ffmpeg_path=FFMPEG_BIN,
+                         track_id=track.get("id"), progress=progress, track=track, audio_format=audio_format)
+
+def make_track_processor(job_id, options, deadline, report=None, prefetcher=None):
+    """
+    Returns process_track(track, folder, file_stem=None, position=1) for the job's options,
+    which puts the finished track at folder/file_stem.<ext> and returns its path (None on failure).
+    Progress goes to report (report_track_progress by default). With a prefetcher, audio it
+    already downloaded ahead is used for the first attempt.
+    """
+    sound_quality = options["sound_quality"]
+    metadata_option = options["metadata_option"]
+    flags = metadata_flags(metadata_option)
+    audio_format = audio_format_name(options.get("audio_format"))
+    extension = AUDIO_FORMATS[audio_format]["ext"]
+    report = report or report_track_progress
+    
+    def process_track(track, folder, file_stem=None, position=1):
+        base_fn = track_basename(track)
+        file_stem = file_stem or base_fn
+        output_path = os.path.join(folder, f"{file_stem}.{extension}")
+        def progress(stage, **info):
+            report(job_id, position, base_fn, stage, **info)
+        def give_up(error):
+            logger.error(f"Giving up on '{base_fn}': {error}")
+            progress("failed", error=str(error))
+            return None
+        # What the look-ahead did for the track (see LocalTrackRunner.fetch): None if it left the
+        # track alone, else (cache path, claim, source path, error). It claimed the track before
+        # downloading and the claim is ours now, from here on other jobs may wait for it.
+        prefetched_future = prefetcher.take(folder, file_stem) if prefetcher else None
+        ahead = None
+        if prefetched_future is not None:
+            try:
+                ahead = wait_until(prefetched_future, deadline)
+            except TimeBudgetExceeded as e:
+                # The download is still running, its audio and claim go once it is over
+                discard_prefetched(prefetched_future)
+                return give_up(e)
+        if ahead and ahead[1]:
+            adopt_track(ahead[1])
+        cache_path = track_cache_path(track, sound_quality, metadata_option, audio_format)
+        prefetched = None
+        if ahead is None:
+            if cache_path and track_cache_lookup(cache_path):
+                count_metric("ssssd_cache_hits_total", cache="track")
+                logger.info(f"Using cached track: {base_fn}")
+                link_or_copy(cache_path, output_path)
+                progress("cached")
+                return output_path
+            count_metric("ssssd_cache_misses_total", cache="track")
+            if not cache_path:
+                return produce_track(track, folder, file_stem, output_path, None, progress)
+            # If another job is already working on this track, wait for it and reuse its file
+            owner, future = claim_track(cache_path)
+            if not owner and future is None:
+                # Only another job's look-ahead has it, which may be stuck behind this job
+                return produce_track(track, folder, file_stem, output_path, None, progress)
+            if not owner:
+                logger.info(f"Waiting for another job to finish: {base_fn}")
+                progress("waiting")
+                try:
+                    shared_path = wait_until(future, deadline)
+                except TimeBudgetExceeded as e:
+                    return give_up(e)
+                if shared_path and os.path.exists(shared_path):
+                    link_or_copy(shared_path, output_path)
+                    progress("cached")
+                    return output_path
+                progress("failed")
+                return None
+        else:
+            count_metric("ssssd_cache_misses_total", cache="track")
+            _, future, source_path, error = ahead
+            prefetched = (source_path, error)
+        try:
+            if cache_path and track_cache_lookup(cache_path):
+                drop_prefetched(ahead)
+                link_or_copy(cache_path, output_path)
+                progress("cached")
+                if future:
+                    future.set_result(cache_path)
+                return output_path
+            result = produce_track(track, folder, file_stem, output_path, cache_path, progress, prefetched)
+            if future:
+                future.set_result(cache_path if result and os.path.exists(cache_path) else result)
+            return result
+        finally:
+            if future:
+                release_track(cache_path, future)
+    
+    def produce_track(track, folder, file_stem, output_path, cache_path, progress, prefetched=None):
+        with metrics_lock:
+            active_workers["track"] += 1
+        try:
+            with timed_stage("track"):
+                return produce_track_attempts(track, folder, file_stem, output_path, cache_path, progress,
+                                              prefetched)
+        finally:
+            with metrics_lock:
+                active_workers["track"] -= 1
+    
+    def produce_track_attempts(track, folder, file_stem, output_path, cache_path, progress, prefetched):
+        base_fn = track_basename(track)
+        def attempt(number):
+            if number == 0 and prefetched is not None:
+                # The download ahead counts as the first attempt, if it failed the next one downloads again
+                source_path, error = prefetched
+                if error is not None:
+                    count_metric("ssssd_prefetch_total", outcome="failed")
+                    raise error
+                count_metric("ssssd_prefetch_total", outcome="used")
+            else:
+                logger.info(f"Downloading track: {base_fn}")
+                source_path = fetch_track_source(track, folder, file_stem, audio_format, progress)
+            try:
+                # Conversion and tagging happen in one FFmpeg run
+                progress("encode", attempt=number + 1)
+                encode_track(source_path, output_path, track, ffmpeg_bin=FFMPEG_BIN,
+                             sound_quality=sound_quality, audio_format=audio_format, **flags)
+            finally:
+                remove_file(source_path)
+            if cache_path:
+                track_cache_store(output_path, cache_path)
+            return output_path
+        try:
+            return call_with_retry(attempt, "track", deadline=deadline)
+        except Exception as e:
+            return give_up(e)
+    
+    return process_track
+
+def drop_prefetched(ahead):
+    """
+    Removes audio that was downloaded ahead but isn't needed (e.g. the track was in the cache
+    after all). The caller resolves and releases the claim; see discard_prefetched otherwise.
+    """
+    if ahead and ahead[2]:
+        count_metric("ssssd_prefetch_total", outcome="discarded")
+        remove_file(ahead[2])
+
+def discard_prefetched(prefetched):
+    """Drops a download ahead that no track took, and gives up its claim once it is over."""
+    def discard(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        ahead = future.result()
+        if ahead:
+            drop_prefetched(ahead)
+            cache_path, claim = ahead[0], ahead[1]
+            if claim:
+                release_track(cache_path, claim)
+    prefetched.add_done_callback(discard)
+
+class TrackPrefetcher:
+    """
+    Look-ahead stage of a job: downloads the audio of the next tracks in line while the tracks
+    before them are encoded and tagged, so the network isn't idle while FFmpeg works and the
+    other way round, even with a single track worker. Up to PREFETCH_TRACKS tracks are
+    downloaded or waiting ahead, and no new one is started while the waiting files take more
+    than PREFETCH_MAX_BYTES. fetch(track, folder, file_stem, position) returns what the track's
+    process_track takes over (see LocalTrackRunner.fetch).
+    """
+    def __init__(self, fetch, tracks=PREFETCH_TRACKS, max_bytes=PREFETCH_MAX_BYTES):
+        self.fetch = fetch
+        self.tracks = tracks
+        self.max_bytes = max_bytes
+        # (folder, file_stem) -> arguments for fetch, in the order the tracks were offered
+        self.pending = {}
+        # (folder, file_stem) -> future of a started download that no track has taken yet
+        self.started = {}
+        # (folder, file_stem) -> size of a finished download that no track has taken yet
+        self.sizes = {}
+        # Reentrant, a download that is already over runs its callback right in fill()
+        self.lock = threading.RLock()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, tracks), thread_name_prefix="ssssd-prefetch")
+
+    def offer(self, track, folder, file_stem, position):
+        """Queues the track for downloading ahead."""
+        if self.tracks <= 0:
+            return
+        with self.lock:
+            self.pending[(folder, file_stem)] = (track, folder, file_stem, position)
+            self.fill()
+
+    def fill(self):
+        # Called with the lock held
+        while self.pending and len(self.started) < self.tracks and sum(self.sizes.values()) < self.max_bytes:
+            key = next(iter(self.pending))
+            args = self.pending.pop(key)
+            future = self.pool.submit(self.fetch, *args)
+            self.started[key] = future
+            future.add_done_callback(lambda f, key=key: self.fetched(key, f))
+
+    def fetched(self, key, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        ahead = future.result()
+        try:
+            size = os.path.getsize(ahead[2]) if ahead and ahead[2] else 0
+        except OSError:
+            size = 0
+        with self.lock:
+            if key in self.started:
+                self.sizes[key] = size
+
+    def take(self, folder, file_stem):
+        """
+        Returns the future of the track's download ahead, or None if it wasn't started (the track
+        then downloads itself). Either way the track leaves the look-ahead and the next one moves up.
+        """
+        key = (folder, file_stem)
+        with self.lock:
+            self.pending.pop(key, None)
+            future = self.started.pop(key, None)
+            self.sizes.pop(key, None)
+            self.fill()
+        return future
+
+    def close(self):
+        """Stops downloading ahead and removes the audio no track took."""
+        with self.lock:
+            self.pending.clear()
+            leftovers = list(self.started.values())
+            self.started.clear()
+            self.sizes.clear()
+        for future in leftovers:
+            future.cancel()
+            discard_prefetched(future)
+        self.pool.shutdown(wait=True)
+
+class LocalTrackRunner:
+    """Runs the tracks of a job on a thread pool of this process, with a look-ahead for their downloads."""
+    def __init__(self, job_id, options, deadline, workers=TRACK_WORKERS):
+        self.job_id = job_id
+        self.options = options
+        self.prefetcher = TrackPrefetcher(self.fetch)
+        self.process_track = make_track_processor(job_id, options, deadline, prefetcher=self.prefetcher)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ssssd-track")
+
+    def cache_path(self, track):
+        return track_cache_path(track, self.options["sound_quality"], self.options["metadata_option"],
+                                self.options.get("audio_format"))
+
+    def fetch(self, track, folder, file_stem, position):
+        """
+        Downloads the track ahead. The track is claimed first, like process_track does, so other
+        look-aheads leave it alone; workers of other jobs don't wait for the claim until this
+        job's worker took it over (see claim_track). Returns None if the track is in the
+        cache or another job is making it, else (cache path, claim, source path, error), which the
+        track's process_track takes over (the claim is None for tracks without a cache path).
+        """
+        cache_path = self.cache_path(track)
+        claim = None
+        if cache_path:
+            if os.path.exists(cache_path):
+                return None
+            owner, claim = claim_track(cache_path, lookahead=True)
+            if not owner:
+                return None
+        def progress(stage, **info):
+            report_track_progress(self.job_id, position, track_basename(track), stage, **info)
+        try:
+            source_path = fetch_track_source(track, folder, file_stem,
+                                             audio_format_name(self.options.get("audio_format")), progress)
+        except Exception as e:
+            return cache_path, claim, None, e
+        return cache_path, claim, source_path, None
+
+    def needs_download(self, track):
+        """Tracks in the cache, or being made by another job, aren't downloaded ahead."""
+        cache_path = self.cache_path(track)
+        if not cache_path:
+            return True
+        with inflight_tracks_lock:
+            if cache_path in inflight_tracks:
+                return False
+        return not os.path.exists(cache_path)
+
+    def submit(self, track, folder, file_stem=None, position=1, on_done=None):
+        """Returns a Future of the track's path (None on failure); on_done(path) is called before it resolves."""
+        if self.needs_download(track):
+            # Same file name as process_track uses
+            self.prefetcher.offer(track, folder, file_stem or track_basename(track), position)
+        def run():
+            output_path = self.process_track(track, folder, file_stem, position)
+            if on_done:
+                on_done(output_path)
+            return output_path
+        return self.pool.submit(run)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.pool.shutdown(wait=True)
+        finally:
+            self.prefetcher.close()
+
+def make_track_runner(job_id, options, deadline):
+    # The tracks run in this process, or on the workers of the shared job store
+    if WORKER_STORE_PATH:
+        return RemoteTrackRunner(job_id, options, deadline)
+    return LocalTrackRunner(job_id, options, deadline)
+
+def get_batch_collections(sp, urls, playlist_order="as_is"):
+    """
+    Fetches the complete listing of every (url_type, spotify_id) of a batch.
+    Returns (folder name, tracks) pairs: one per album or playlist, and "Tracks" for single tracks.
+    """
+    collections = []
+    singles = []
+    names = set()
+    for url_type, spotify_id in urls:
+        items, name = get_items_from_spotify(sp, url_type, spotify_id)
+        items = list(items)
+        if url_type == "track":
+            singles.extend(items)
+            continue
+        if url_type == "playlist" and playlist_order == "reverse":
+            items.reverse()
+        # Albums or playlists with the same name each get their own folder
+        folder, n = sanitize_filename(name), 1
+        while folder in names:
+            n += 1
+            folder = f"{sanitize_filename(name)} ({n})"
+        names.add(folder)
+        collections.append((folder, items))
+    if singles:
+        folder = "Tracks" if "Tracks" not in names else "Tracks (singles)"
+        collections.append((folder, singles))
+    return collections
+
+def run_download(job_id, options):
+    """
+    Fetches the Spotify items for a job and downloads them into the job's own folder.
+    Returns the arguments for the result template (files, zip_file, error).
+    """
+    url_type = options["url_type"]
+    spotify_id = options["spotify_id"]
+    playlist_order = options["playlist_order"]
+    # Retries stop once the job has used up its time budget
+    deadline = time.time() + JOB_TIME_BUDGET
+    if url_type == "playlist" and options.get("sync"):
+        return sync_playlist(job_id, options, deadline)
+    
+    sp = get_spotify_client()
+    try:
+        if url_type == "batch":
+            # Every listing is complete before the first track starts, so tracks found in
+            # several albums and playlists are only downloaded once
+            collections = get_batch_collections(sp, options["urls"], playlist_order)
+        else:
+            items, collection_name = get_items_from_spotify(sp, url_type, spotify_id)
+            # If user selects reverse order, reverse the items list (this needs the complete listing)
+            if url_type == "playlist" and playlist_order == "reverse":
+                items = list(items)
+                items.reverse()
+    except Exception as e:
+        error = f"Failed to fetch items: {e}"
+        return {"files": None, "zip_file": None, "error": error}
+    
+    job_dir = os.path.join(DOWNLOADS_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    runner = make_track_runner(job_id, options, deadline)
+    
+    if url_type == "batch":
+        # One folder per album or playlist, also inside the ZIP
+        return download_collections(job_id, runner, job_dir, "Batch", collections, nested=True)
+    # For single track downloads
+    if url_type == "track" or len(items) == 1:
+        track = next(iter(items), None)
+        with runner:
+            output_path = runner.submit(track, job_dir).result() if track else None
+        if output_path:
+            report_track_progress(job_id, 1, track_basename(track), "done")
+            files = [f"{job_id}/{os.path.basename(output_path)}"]
+            return {"files": files, "zip_file": None, "error": None}
+        else:
+            error = "Failed to download the song after multiple attempts."
+            return {"files": None, "zip_file": None, "error": error}
+    else:
+        # For album or playlist downloads (tracks are processed concurrently)
+        return download_collections(job_id, runner, job_dir, collection_name,
+                                    [(sanitize_filename(collection_name), items)])
+
+def download_collections(job_id, runner, job_dir, zip_name, collections, nested=False):
+    """
+    Downloads the tracks of (folder name, items) collections into job_dir/<folder name> and
+    offers them as one ZIP, with the folders kept in the ZIP if nested. Progress positions run
+    on across the collections. Returns the arguments for the result template.
+    """
+    total = sum(len(items) for _, items in collections)
+    for folder, items in collections:
+        os.makedirs(os.path.join(job_dir, folder), exist_ok=True)
+        logger.info(f"Downloading {len(items)} tracks into folder '{os.path.join(job_dir, folder)}'")
+    add_job_event(job_id, type="job", status="running", total=total)
+    # The ZIP can be streamed from now on, finished tracks are added to it as they come in
+    zip_file_name = sanitize_filename(zip_name) + ".zip"
+    update_job(job_id, zip_file=zip_file_name)
+    
+    def arcname(path):
+        name = os.path.basename(path)
+        return f"{os.path.basename(os.path.dirname(path))}/{name}" if nested else name
+    
+    def collection_track_done(track, position):
+        def on_done(output_path):
+            if output_path:
+                add_job_entry(job_id, arcname(output_path), output_path)
+                report_track_progress(job_id, position, track_basename(track), "done")
+        return on_done
+    
+    # Files are named after their position in the 'items' list (which may be reversed
+    # if selected) right away, so finished tracks can be handed out before the others.
+    # Tracks are submitted while the listing is still being fetched.
+    # A track listed twice (also in different collections) is only downloaded once and
+    # copied to its other positions. Tracks count as the same by Spotify ID, not by name,
+    # since the same title on another album comes with other tags and cover.
+    first_futures = {}
+    duplicates = []
+    position = 0
+    with runner:
+        for folder, items in collections:
+            collection_folder = os.path.join(job_dir, folder)
+            # Enough digits for the position prefix that files still sort in order
+            width = max(2, len(str(len(items))))
+            for idx, track in enumerate(items, start=1):
+                position += 1
+                base_fn = track_basename(track)
+                file_stem = f"{idx:0{width}d} - {base_fn}"
+                key = sync_track_key(track)
+                report_track_progress(job_id, position, base_fn, "queued")
+                if key in first_futures:
+                    duplicates.append((first_futures[key], collection_folder, file_stem, position))
+                else:
+                    first_futures[key] = runner.submit(track, collection_folder, file_stem, position,
+                                                           on_done=collection_track_done(track, position))
+        outputs = [future.result() for future in first_futures.values()]
+    
+    for future, collection_folder, file_stem, position in duplicates:
+        output_path = future.result()
+        if output_path:
+            copy_path = os.path.join(collection_folder, file_stem + os.path.splitext(output_path)[1])
+            link_or_copy(output_path, copy_path)
+            add_job_entry(job_id, arcname(copy_path), copy_path)
+            report_track_progress(job_id, position, file_stem.split(" - ", 1)[1], "done")
+        else:
+            report_track_progress(job_id, position, file_stem.split(" - ", 1)[1], "failed")
+    
+    if not any(outputs):
+        return {"files": None, "zip_file": None, "error": "Failed to download any of the tracks."}
+    logger.info(f"Finished {sum(1 for o in outputs if o)} of {len(outputs)} tracks of '{zip_name}'")
+    return {"files": None, "zip_file": zip_file_name, "error": None}
+
+# -------------------------------
+# Playlist sync
+# -------------------------------
+# A synced playlist lives in SYNC_DIR/<playlist>-<options> with a manifest.json listing its
+# snapshot_id and, per position, the Spotify track ID and file. A new sync compares the manifest
+# with the current playlist: only added tracks are downloaded, removed ones are deleted and the
+# rest are renamed to their new position. If the snapshot_id didn't change, the listing isn't
+# even fetched. The job then gets hard links to the files, so it is served like any other job.
+sync_locks = {}
+sync_locks_lock = threading.Lock()
+
+def sync_folder(options):
+    _, spotify_id, audio_format, quality, profile, order, _ = job_key(options)
+    return os.path.join(SYNC_DIR, sanitize_filename(f"{spotify_id}-{audio_format}-{quality or 'source'}-{profile}-{order}"))
+
+def load_sync_manifest(folder):
+    try:
+        with open(os.path.join(folder, "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring the unreadable manifest of {folder}: {e}")
+        return None
+
+def save_sync_manifest(folder, manifest):
+    path = os.path.join(folder, "manifest.json")
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp_path, path)
+
+def sync_track_key(track):
+    # Local files have no Spotify ID
+    return track.get("id") or track_basename(track)
+
+def plan_playlist_sync(manifest, items, folder, extension):
+    """
+    Compares the manifest with the playlist's current items. Returns (kept, added, removed):
+    kept is (position, manifest entry, new file name), added is (position, track, file stem) and
+    removed the files of tracks no longer in the playlist. A track listed twice keeps both files.
+    """
+    existing = {}
+    for entry in manifest["tracks"] if manifest else []:
+        if os.path.exists(os.path.join(folder, entry["file"])):
+            existing.setdefault(entry["key"], []).append(entry)
+    kept = []
+    added = []
+    width = max(2, len(str(len(items))))
+    for idx, track in enumerate(items, start=1):
+        file_stem = f"{idx:0{width}d} - {track_basename(track)}"
+        candidates = existing.get(sync_track_key(track))
+        if candidates:
+            kept.append((idx, candidates.pop(0), f"{file_stem}.{extension}"))
+        else:
+            added.append((idx, track, file_stem))
+    removed = [entry["file"] for entries in existing.values() for entry in entries]
+    return kept, added, removed
+
+def apply_sync_renames(folder, renames):
+    """Renames (old, new) file pairs, through temporary names so a file can take a name another one is leaving."""
+    temp_names = []
+    for old, new in renames:
+        temp_name = f"{new}.{uuid.uuid4().hex}.tmp"
+        os.replace(os.path.join(folder, old), os.path.join(folder, temp_name))
+        temp_names.append((temp_name, new))
+    for temp_name, new in temp_names:
+        os.replace(os.path.join(folder, temp_name), os.path.join(folder, new))
+
+def fetch_playlist_snapshot(sp, spotify_id):
+    """The playlist's current snapshot_id, always asked from Spotify (it is what tells whether anything changed)."""
+    with upstream_call("spotify"), timed_stage("spotify_fetch"):
+        return sp.playlist(spotify_id, fields="snapshot_id").get("snapshot_id")
+
+def sync_playlist(job_id, options, deadline):
+    """
+    Runs a playlist job in sync mode (see above). Returns the arguments for the result template.
+    """
+    spotify_id = options["spotify_id"]
+    folder = sync_folder(options)
+    extension = AUDIO_FORMATS[audio_format_name(options.get("audio_format"))]["ext"]
+    with sync_locks_lock:
+        sync_lock = sync_locks.setdefault(folder, threading.Lock())
+    with sync_lock:
+        os.makedirs(folder, exist_ok=True)
+        manifest = load_sync_manifest(folder)
+        sp = get_spotify_client()
+        try:
+            snapshot_id = fetch_playlist_snapshot(sp, spotify_id)
+            unchanged = (manifest is not None and snapshot_id and manifest.get("snapshot_id") == snapshot_id
+                         and all(os.path.exists(os.path.join(folder, e["file"])) for e in manifest["tracks"]))
+            if unchanged:
+                collection_name = manifest["name"]
+                kept = [(entry["position"], entry, entry["file"]) for entry in manifest["tracks"]]
+                added, removed = [], []
+            else:
+                # A cached listing may be from before the change
+                forget_spotify_cache(spotify_id)
+                items, collection_name = get_items_from_spotify(sp, "playlist", spotify_id)
+                items = list(items)
+                if options["playlist_order"] == "reverse":
+                    items.reverse()
+                kept, added, removed = plan_playlist_sync(manifest, items, folder, extension)
+        except Exception as e:
+            error = f"Failed to fetch items: {e}"
+            return {"files": None, "zip_file": None, "error": error}
+        logger.info(f"Syncing '{collection_name}': {len(kept)} kept, {len(added)} added, {len(removed)} removed")
+        
+        for file in removed:
+            remove_file(os.path.join(folder, file))
+        apply_sync_renames(folder, [(entry["file"], new) for _, entry, new in kept if entry["file"] != new])
+        tracks = [dict(entry, position=position, file=new) for position, entry, new in kept]
+        # Files that are in the manifest are on disk, a sync that fails halfway is picked up next time
+        save_sync_manifest(folder, {"playlist_id": spotify_id, "name": collection_name, "snapshot_id": None,
+                                    "tracks": sorted(tracks, key=lambda t: t["position"])})
+        
+        job_dir = os.path.join(DOWNLOADS_DIR, job_id)
+        collection_folder = os.path.join(job_dir, sanitize_filename(collection_name))
+        os.makedirs(collection_folder, exist_ok=True)
+        add_job_event(job_id, type="job", status="running", total=len(kept) + len(added))
+        zip_file_name = sanitize_filename(collection_name) + ".zip"
+        update_job(job_id, zip_file=zip_file_name)
+        for entry in tracks:
+            job_path = os.path.join(collection_folder, entry["file"])
+            link_or_copy(os.path.join(folder, entry["file"]), job_path)
+            add_job_entry(job_id, entry["file"], job_path)
+            report_track_progress(job_id, entry["position"], entry["name"], "done")
+        
+        # Only the added tracks are downloaded, into the job's folder, and linked into the playlist's
+        tracks_lock = threading.Lock()
+        def add_to_sync(track, position):
+            def on_done(output_path):
+                if not output_path:
+                    return
+                file = os.path.basename(output_path)
+                link_or_copy(output_path, os.path.join(folder, file))
+                with tracks_lock:
+                    tracks.append({"key": sync_track_key(track), "name": track_basename(track),
+                                   "position": position, "file": file})
+                add_job_entry(job_id, file, output_path)
+                report_track_progress(job_id, position, track_basename(track), "done")
+            return on_done
+        
+        first_futures = {}
+        duplicates = []
+        with make_track_runner(job_id, options, deadline) as runner:
+            for idx, track, file_stem in added:
+                key = sync_track_key(track)
+                report_track_progress(job_id, idx, track_basename(track), "queued")
+                if key in first_futures:
+                    duplicates.append((first_futures[key], track, file_stem, idx))
+                else:
+                    first_futures[key] = runner.submit(track, collection_folder, file_stem, idx,
+                                                       on_done=add_to_sync(track, idx))
+            outputs = [future.result() for future in first_futures.values()]
+        for future, track, file_stem, idx in duplicates:
+            output_path = future.result()
+            if output_path:
+                copy_path = os.path.join(collection_folder, file_stem + os.path.splitext(output_path)[1])
+                link_or_copy(output_path, copy_path)
+                add_to_sync(track, idx)(copy_path)
+            else:
+                report_track_progress(job_id, idx, track_basename(track), "failed")
+        
+        # The snapshot only counts as synced if every track made it, otherwise the next sync retries the rest
+        complete = all(outputs) and len(tracks) == len(kept) + len(added)
+        save_sync_manifest(folder, {"playlist_id": spotify_id, "name": collection_name,
+                                    "snapshot_id": snapshot_id if complete else None,
+                                    "tracks": sorted(tracks, key=lambda t: t["position"])})
+    if not tracks:
+        return {"files": None, "zip_file": None, "error": "Failed to download any of the tracks."}
+    logger.info(f"Synced {len(tracks)} of {len(kept) + len(added)} tracks of '{collection_name}'")
+    return {"files": None, "zip_file": zip_file_name, "error": None}
+
+@route("/downloads/<path:filename>")
+def downloaded_file(filename):
+    # Files are served from the folder of the job that made them, which stays until the response is sent
+    job_id = filename.split("/", 1)[0]
+    if not begin_transfer(job_id):
+        abort(404)
+    try:
+        response = send_download(filename)
+    except Exception:
+        end_transfer(job_id)
+        raise
+    return end_transfer_on_close(response, job_id)
+
+def send_download(filename, as_attachment=False):
+    """
+    Sends a file from the downloads folder. send_from_directory handles Range and conditional
+    requests and uses the server's sendfile support. With ACCEL_REDIRECT_PREFIX set, nginx
+    sends the file instead and the request thread is free right away.
+    """
+    if not ACCEL_REDIRECT_PREFIX:
+        return send_from_directory(DOWNLOADS_DIR, filename, as_attachment=as_attachment)
+    path = safe_join(DOWNLOADS_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    response = Response(mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream")
+    response.headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(filename)
+    if as_attachment:
+        response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(os.path.basename(path))}"
+    return response
+
+# Tracks are copied into the ZIP in chunks of this size
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+class ZipStreamBuffer:
+    """Write-only file object that collects what zipfile writes until the stream picks it up."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(entries):
+    """
+    Yields a ZIP archive of the (arcname, path) entries while it is being built, nothing is
+    written to disk. MP3s hardly compress, so they are stored instead of deflated.
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zipf:
+        for arcname, path in entries:
+            try:
+                zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                src = open(path, "rb")
+            except OSError as e:
+                logger.error(f"Could not add {path} to the ZIP: {e}")
+                continue
+            zinfo.compress_type = zipfile.ZIP_STORED
+            start = time.perf_counter()
+            with src, zipf.open(zinfo, "w", force_zip64=zinfo.file_size > zipfile.ZIP64_LIMIT) as dest:
+                for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b""):
+                    dest.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            # Includes the time the client took to receive the track
+            observe_stage("zip", time.perf_counter() - start)
+            data = buffer.drain()
+            if data:
+                yield data
+    yield buffer.drain()
+
+def stream_and_keep_zip(entries, zip_path):
+    """
+    Streams the ZIP like stream_zip and keeps a copy at zip_path once all of it was sent.
+    The entries of a finished job don't change, so the copy matches the streamed bytes
+    (a download resumed with Range continues in the same archive).
+    """
+    temp_path = f"{zip_path}.{uuid.uuid4().hex}.tmp"
+    complete = False
+    try:
+        with open(temp_path, "wb") as f:
+            for data in stream_zip(entries):
+                f.write(data)
+                yield data
+        os.replace(temp_path, zip_path)
+        complete = True
+    finally:
+        if not complete:
+            remove_file(temp_path)
+
+def download_song(query, downloads_dir, base_filename, ffmpeg_path=FFMPEG_BIN, track_id=None, progress=None,
+                  track=None, audio_format="mp3"):
+    """
+    Searches YouTube for the query and downloads the best audio stream as is.
+    The top SEARCH_CANDIDATES results are fetched as a flat list and scored against the
+    Spotify track (duration, title, artist), only the best match is downloaded.
+    If the Spotify track was matched before, the known video is fetched without searching.
+    progress(stage, **info) is called for the search and with the bytes, speed and ETA of the download.
+    Returns the path of the downloaded file; encode_track turns it into the final MP3.
+    Raises PermanentError if nothing was found, other errors are worth retrying.
+    """
+    progress = progress or (lambda stage, **info: None)
+    def progress_hook(d):
+        if d.get("status") in ("downloading", "finished"):
+            total = d.get("total_bytes") or d.get("total_bytes_estimate")
+            progress("download", downloaded_bytes=d.get("downloaded_bytes"), total_bytes=total,
+                     speed=d.get("speed"), eta=d.get("eta"))
+    source_template = os.path.join(downloads_dir, f"{base_filename}.source.%(ext)s")
+    ydl_opts = {
+        # Formats that are kept as is prefer a stream that already has the right codec
+        "format": AUDIO_FORMATS[audio_format_name(audio_format)]["stream"],
+        "outtmpl": source_template,
+        "noplaylist": True,
+        "quiet": True,
+        # Search results only come with their basic metadata, which is all the scoring needs
+        "extract_flat": "in_playlist",
+        "ffmpeg_location": ffmpeg_path,
+        # Retries are handled by call_with_retry; an interrupted download resumes from its .part file
+        "retries": 0,
+        "socket_timeout": SOCKET_TIMEOUT,
+        "progress_hooks": [progress_hook],
+    }
+    import yt_dlp
+    source_path = None
+    try:
+        with worker_slot(fetch_slots, "fetch"):
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                video_url = get_cached_match(track_id) if track_id else None
+                if video_url:
+                    count_metric("ssssd_cache_hits_total", cache="match")
+                    logger.info(f"Using cached match: {video_url}")
+                    try:
+                        with upstream_call("youtube"), timed_stage("media_fetch"):
+                            video_info = ydl.extract_info(video_url, download=True)
+                        source_path = downloaded_filepath(ydl, video_info)
+                    except Exception as e:
+                        count_metric("ssssd_failures_total", stage="media_fetch")
+                        # Throttling, timeouts and server errors say nothing about the match, the
+                        # attempt is retried with backoff and the match is kept
+                        if not is_permanent_error(e):
+                            raise
+                        # The video was removed or blocked, search again
+                        logger.warning(f"Cached match {video_url} failed, searching again: {e}")
+                        invalidate_match(track_id)
+                        video_url = None
+                else:
+                    count_metric("ssssd_cache_misses_total", cache="match")
+                if not video_url:
+                    progress("search")
+                    with upstream_call("youtube"), timed_stage("youtube_search"):
+                        info = ydl.extract_info(f"ytsearch{SEARCH_CANDIDATES}:{query}", download=False)
+                    entries = [e for e in info.get("entries") or [] if e]
+                    if entries:
+                        video = pick_best_candidate(entries, track) if track else entries[0]
+                        video_url = (video.get("webpage_url") or video.get("url")
+                                     or f"https://www.youtube.com/watch?v={video['id']}")
+                        logger.info(f"Found video: {video_url}")
+                        with upstream_call("youtube"), timed_stage("media_fetch"):
+                            video_info = ydl.extract_info(video_url, download=True)
+                        source_path = downloaded_filepath(ydl, video_info)
+                        if track_id:
+                            store_match(track_id, video_url)
+                    else:
+                        raise PermanentError(f"No search results for '{query}'")
+        if source_path and os.path.exists(source_path):
+            return source_path
+        raise Exception("yt-dlp did not produce a file")
+    except Exception as e:
+        logger.error(f"Error downloading song: {e}")
+        remove_file(source_path)
+        raise
+
+# Words in a video title that point to a different version than the one on Spotify
+UNWANTED_VERSION_WORDS = ("live", "cover", "karaoke", "instrumental", "remix", "sped", "slowed",
+                          "nightcore", "reverb", "8d", "acoustic", "lyrics")
+
+def normalize_words(text):
+    return set(re.findall(r"[\w']+", text.lower()))
+
+def score_candidate(entry, track):
+    """Scores a search result against the Spotify track, higher is better."""
+    title = entry.get("title") or ""
+    channel = entry.get("channel") or entry.get("uploader") or ""
+    video_words = normalize_words(title)
+    score = 0.0
+    
+    # Duration is the strongest signal: other versions (live, extended, edits) differ in length
+    duration = entry.get("duration")
+    track_seconds = (track.get("duration_ms") or 0) / 1000
+    if duration and track_seconds:
+        difference = abs(duration - track_seconds)
+        score += 0.5 * max(0.0, 1 - difference / max(10.0, 0.1 * track_seconds))
+        if difference > max(30.0, 0.25 * track_seconds):
+            score -= 0.5
+    
+    # Strip "- Remastered 2011", "(feat. ...)" and the like from the Spotify title
+    track_title = re.split(r" - |\(|\[", track.get("name", ""))[0]
+    title_words = normalize_words(track_title)
+    if title_words:
+        score += 0.3 * len(title_words & video_words) / len(title_words)
+    
+    channel_words = normalize_words(channel)
+    for artist in track.get("artists", []):
+        artist_words = normalize_words(artist.get("name", ""))
+        if artist_words and (artist_words <= video_words or artist_words <= channel_words):
+            score += 0.2
+            break
+    # Auto-generated "Artist - Topic" channels carry the studio version
+    if channel.endswith(" - Topic"):
+        score += 0.1
+    
+    spotify_words = normalize_words(track.get("name", ""))
+    for word in UNWANTED_VERSION_WORDS:
+        if word in video_words and word not in spotify_words:
+            score -= 0.3
+    return score
+
+def pick_best_candidate(entries, track):
+    scored = [(score_candidate(entry, track), -i, entry) for i, entry in enumerate(entries)]
+    score, _, best = max(scored, key=lambda s: (s[0], s[1]))
+    logger.info(f"Picked '{best.get('title')}' (score {score:.2f}) out of {len(entries)} results")
+    return best
+
+def downloaded_filepath(ydl, info):
+    requested = info.get("requested_downloads") or []
+    if requested and requested[0].get("filepath"):
+        return requested[0]["filepath"]
+    return ydl.prepare_filename(info)
+
+def remove_file(path):
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+        except Exception as e:
+            logger.warning(f"Could not remove {path}: {e}")
+
+def build_metadata_opts(track, include_title=True, include_artist=True, include_album=True,
+                        include_date=True, include_track=True, include_disc=True, **_):
+    metadata_opts = []
+    if include_title:
+        t = track.get("name", "")
+        if t:
+            metadata_opts.extend(["-metadata", f"title={t}"])
+    if include_artist:
+        artists = ", ".join([a["name"] for a in track.get("artists", [])])
+        if artists:
+            metadata_opts.extend(["-metadata", f"artist={artists}"])
+    if include_album and "album" in track:
+        album_name = track["album"].get("name", "")
+        if album_name:
+            metadata_opts.extend(["-metadata", f"album={album_name}"])
+        if include_date:
+            release_date = track["album"].get("release_date", "")
+            if release_date:
+                metadata_opts.extend(["-metadata", f"date={release_date}"])
+    if include_track and "track_number" in track:
+        metadata_opts.extend(["-metadata", f"track={track.get('track_number', '')}"])
+    if include_disc and "disc_number" in track:
+        metadata_opts.extend(["-metadata", f"disc={track.get('disc_number', '')}"])
+    return metadata_opts
+
+# -------------------------------
+# Album art
+# -------------------------------
+# Covers are fetched over one pooled session and kept on disk by image URL. Concurrent
+# tracks of the same album wait for a single download instead of each fetching it.
+art_session = None
+art_lock = threading.Lock()
+art_fetch_locks = {}
+# Image URL -> time until which it isn't tried again after a failed download
+art_failures = {}
+
+def get_art_session():
+    global art_session
+    with art_lock:
+        if art_session is None:
+            import requests
+            art_session = requests.Session()
+            art_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4,
+                                                                        pool_maxsize=FETCH_CONCURRENCY))
+        return art_session
+
+def album_art_cache_path(image_url):
+    return os.path.join(ART_CACHE_DIR, hashlib.sha1(image_url.encode("utf-8")).hexdigest() + ".jpg")
+
+def fetch_album_art(image_url):
+    """Returns the cached cover for the image URL, downloading it if needed. Returns None on failure."""
+    art_path = album_art_cache_path(image_url)
+    if os.path.exists(art_path):
+        count_metric("ssssd_cache_hits_total", cache="art")
+        return art_path
+    with art_lock:
+        if art_failures.get(image_url, 0) > time.time():
+            return None
+        fetch_lock = art_fetch_locks.setdefault(image_url, threading.Lock())
+    with fetch_lock:
+        if os.path.exists(art_path):
+            return art_path
+        count_metric("ssssd_cache_misses_total", cache="art")
+        try:
+            with timed_stage("album_art"):
+                response = get_art_session().get(image_url, timeout=ART_TIMEOUT)
+            if response.status_code != 200:
+                raise Exception(f"Non-200 response ({response.status_code})")
+            os.makedirs(ART_CACHE_DIR, exist_ok=True)
+            temp_path = f"{art_path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(response.content)
+            os.replace(temp_path, art_path)
+        except Exception as e:
+            count_metric("ssssd_failures_total", stage="album_art")
+            logger.error(f"Error downloading album art: {e}")
+            with art_lock:
+                art_failures[image_url] = time.time() + 60
+            return None
+        finally:
+            with art_lock:
+                art_fetch_locks.pop(image_url, None)
+    evict_album_art()
+    return art_path
+
+def evict_album_art():
+    entries = [(entry.stat().st_mtime, entry.path) for entry in os.scandir(ART_CACHE_DIR) if entry.is_file()]
+    if len(entries) > ART_CACHE_MAX_FILES:
+        entries.sort()
+        for _, path in entries[:len(entries) - ART_CACHE_MAX_FILES]:
+            remove_file(path)
+
+def get_album_art(track):
+    """
+    Returns the album cover to embed for the track.
+    If album art download fails, falls back to default thumbnail "d.png".
+    """
+    if "album" in track and track["album"].get("images"):
+        art_path = fetch_album_art(track["album"]["images"][0]["url"])
+        if art_path:
+            return art_path
+    if os.path.exists(DEFAULT_THUMB):
+        logger.info("Using default thumbnail.")
+        return DEFAULT_THUMB
+    logger.warning("No album art available and default thumbnail not found.")
+    return None
+
+def opus_picture_tag(image_path):
+    """
+    Returns the cover as a base64 METADATA_BLOCK_PICTURE comment, which is how Ogg files
+    carry cover art (FFmpeg can't mux an image stream into Ogg).
+    """
+    with open(image_path, "rb") as f:
+        data = f.read()
+    mime = (mimetypes.guess_type(image_path)[0] or "image/jpeg").encode("ascii")
+    description = b"Cover (front)"
+    # FLAC picture block: type 3 (front cover), MIME, description, unknown size/depth, data
+    block = (struct.pack(">II", 3, len(mime)) + mime + struct.pack(">I", len(description)) + description
+             + struct.pack(">IIIII", 0, 0, 0, 0, len(data)) + data)
+    return base64.b64encode(block).decode("ascii")
+
+def write_ffmetadata(path, tags):
+    """Writes tags in FFmpeg's metadata file format (used for values too long for the command line)."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(";FFMETADATA1\n")
+        for key, value in tags.items():
+            f.write(key + "=" + re.sub(r"([=;#\\\n])", r"\\\1", value) + "\n")
+
+def encode_track(source_path, output_path, track, ffmpeg_bin=FFMPEG_BIN, sound_quality="192",
+                 audio_format="mp3", include_thumbnail=True, **metadata_options):
+    """
+    Writes the downloaded audio to output_path and embeds the metadata (title, artist, album,
+    date, track, disc) and cover image in the same FFmpeg run, so the audio is only written once.
+    MP3 is encoded from the source. M4A and Opus copy the source audio stream and only fall
+    back to encoding when YouTube didn't have a stream in that codec.
+    """
+    output_format = AUDIO_FORMATS[audio_format_name(audio_format)]
+    metadata_opts = build_metadata_opts(track, **metadata_options)
+    # The cover is only read by FFmpeg, so all tracks of an album can share the cached file
+    album_art_path = get_album_art(track) if include_thumbnail else None
+    
+    cmd = [ffmpeg_bin, "-y", "-i", source_path]
+    metadata_file = None
+    if album_art_path and output_format["ext"] == "opus":
+        metadata_file = f"{output_path}.{uuid.uuid4().hex}.ffmeta"
+        write_ffmetadata(metadata_file, {"METADATA_BLOCK_PICTURE": opus_picture_tag(album_art_path)})
+        cmd += ["-i", metadata_file, "-map", "0:a:0", "-map_metadata", "1"]
+    elif album_art_path:
+        cmd += ["-i", album_art_path, "-map", "0:a:0", "-map", "1:0", "-c:v", "copy", "-disposition:v:0", "attached_pic",
+                "-metadata:s:v", "title=Album cover", "-metadata:s:v", "comment=Cover (front)"]
+    else:
+        cmd += ["-map", "0:a:0"]
+    
+    def run(codec_opts, stage):
+        full_cmd = cmd + codec_opts + metadata_opts + [output_path]
+        logger.info("Running FFmpeg for conversion and metadata embedding: " + " ".join(full_cmd))
+        with worker_slot(ffmpeg_slots, "ffmpeg"), timed_stage(stage):
+            return subprocess.run(full_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    
+    try:
+        result = None
+        if output_format["copy"]:
+            result = run(["-codec:a", "copy"], "remux")
+            if result.returncode != 0:
+                logger.info(f"Source audio can't be copied into .{output_format['ext']}, encoding it instead")
+        if result is None or result.returncode != 0:
+            result = run(output_format["codec"] + ["-b:a", f"{sound_quality}k"], "encode")
+    finally:
+        remove_file(metadata_file)
+    if result.returncode != 0:
+        remove_file(output_path)
+        raise EncodeError("FFmpeg conversion failed: " + result.stderr.decode("utf-8", "replace"))
+
+# -------------------------------
+# Track cache
+# -------------------------------
+# Encoded tracks are stored by (Spotify track ID, format, bitrate, metadata profile) and
+# hard linked (or copied) into the job folders, so a track is only fetched once.
+track_cache_lock = threading.Lock()
+
+def track_cache_path(track, sound_quality, metadata_option, audio_format="mp3"):
+    """Returns the cache file for the track, or None for tracks without a Spotify ID (local files)."""
+    track_id = track.get("id")
+    if not track_id:
+        return None
+    profile = metadata_option if metadata_option in METADATA_PROFILES else "all"
+    audio_format = audio_format_name(audio_format)
+    if AUDIO_FORMATS[audio_format]["copy"]:
+        # Copied audio doesn't depend on the bitrate
+        name = f"{track_id}-{audio_format}-{profile}.{AUDIO_FORMATS[audio_format]['ext']}"
+    else:
+        name = f"{track_id}-{sound_quality}-{profile}.mp3"
+    return os.path.join(TRACK_CACHE_DIR, sanitize_filename(name))
+
+def track_cache_lookup(cache_path):
+    if not os.path.exists(cache_path):
+        return False
+    try:
+        # The modification time doubles as the "last used" time for eviction
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return True
+
+def track_cache_store(output_path, cache_path):
+    if TRACK_CACHE_MAX_BYTES <= 0:
+        return
+    os.makedirs(TRACK_CACHE_DIR, exist_ok=True)
+    temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        link_or_copy(output_path, temp_path)
+        os.replace(temp_path, cache_path)
+    except Exception as e:
+        logger.warning(f"Could not add {output_path} to the track cache: {e}")
+        remove_file(temp_path)
+        return
+    evict_track_cache()
+
+def evict_track_cache():
+    """Removes the least recently used tracks until the cache fits in TRACK_CACHE_MAX_BYTES."""
+    with track_cache_lock:
+        entries = []
+        total = 0
+        for entry in os.scandir(TRACK_CACHE_DIR):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= TRACK_CACHE_MAX_BYTES:
+                break
+            remove_file(path)
+            total -= size
+            logger.info(f"Evicted {os.path.basename(path)} from the track cache")
+
+def link_or_copy(src, dst):
+    """Hard links src to dst, falling back to a copy (e.g. across file systems)."""
+    remove_file(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+# Tracks being produced right now, by cache path, so concurrent jobs don't fetch the same track twice
+inflight_tracks = {}
+inflight_tracks_lock = threading.Lock()
+# Claims a look-ahead took for tracks no worker of its job has started yet. Nobody may wait for
+# those: two jobs with the same tracks in opposite order would each wait for the other forever.
+lookahead_claims = set()
+
+def claim_track(cache_path, lookahead=False):
+    """
+    Returns (True, future) if the caller is now responsible for producing the track and must
+    resolve the future with the produced file, or (False, future) of the job already doing it.
+    If the track is only claimed by another job's look-ahead, (False, None) is returned.
+    """
+    with inflight_tracks_lock:
+        future = inflight_tracks.get(cache_path)
+        if future is not None:
+            return False, (None if future in lookahead_claims else future)
+        future = inflight_tracks[cache_path] = Future()
+        if lookahead:
+            lookahead_claims.add(future)
+        return True, future
+
+def adopt_track(future):
+    """Hands a claim of the look-ahead over to the worker that now produces the track."""
+    with inflight_tracks_lock:
+        lookahead_claims.discard(future)
+
+def release_track(cache_path, future):
+    with inflight_tracks_lock:
+        lookahead_claims.discard(future)
+        if inflight_tracks.get(cache_path) is future:
+            del inflight_tracks[cache_path]
+    if not future.done():
+        future.set_result(None)
+
+# -------------------------------
+# YouTube match index
+# -------------------------------
+match_db_lock = threading.Lock()
+match_db_ready = False
+
+def match_db():
+    global match_db_ready
+    os.makedirs(os.path.dirname(MATCH_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(MATCH_DB_PATH, timeout=30)
+    if not match_db_ready:
+        with match_db_lock:
+            if not match_db_ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS matches ("
+                             "track_id TEXT PRIMARY KEY, video_url TEXT NOT NULL, matched_at REAL NOT NULL)")
+                conn.commit()
+                match_db_ready = True
+    return conn
+
+def get_cached_match(track_id):
+    """Returns the YouTube URL matched to the Spotify track, or None if unknown or older than MATCH_TTL."""
+    try:
+        conn = match_db()
+        try:
+            row = conn.execute("SELECT video_url FROM matches WHERE track_id = ? AND matched_at > ?",
+                               (track_id, time.time() - MATCH_TTL)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not read the match index: {e}")
+        return None
+    return row[0] if row else None
+
+def store_match(track_id, video_url):
+    try:
+        conn = match_db()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO matches (track_id, video_url, matched_at) VALUES (?, ?, ?)",
+                             (track_id, video_url, time.time()))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not update the match index: {e}")
+
+def invalidate_match(track_id):
+    """Forgets the match of a track. Returns True if there was one."""
+    try:
+        conn = match_db()
+        try:
+            with conn:
+                deleted = conn.execute("DELETE FROM matches WHERE track_id = ?", (track_id,)).rowcount
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not update the match index: {e}")
+        return False
+    return deleted > 0
+
+@route("/matches/<track_id>", methods=["DELETE"])
+@route("/matches/<track_id>/invalidate", methods=["POST"])
+def forget_match(track_id):
+    """Drops a wrong match, and the tracks encoded from it, so the next request searches again."""
+    found = invalidate_match(track_id)
+    if os.path.isdir(TRACK_CACHE_DIR):
+        for entry in os.scandir(TRACK_CACHE_DIR):
+            if entry.name.startswith(f"{track_id}-"):
+                remove_file(entry.path)
+    return jsonify(track_id=track_id, invalidated=found)
+
+# -------------------------------
+# Worker mode
+# -------------------------------
+# With WORKER_STORE_PATH set, the web process doesn't run the tracks of its jobs itself but
+# queues them in the shared job store. Worker processes ("python main.py worker") on any host
+# claim them one by one, write the files into the job's folder in the shared downloads folder
+# and report their progress through the store, which the web process relays to the job.
+# Paths in the store are relative to DOWNLOADS_DIR, so hosts may mount it in different places.
+# Every change of a task gets the next 'seq', so the web process only reads what changed.
+worker_store_lock = threading.Lock()
+worker_store_ready = False
+
+def worker_store():
+    global worker_store_ready
+    # Autocommit, transactions are started explicitly. The store keeps SQLite's default rollback
+    # journal: WAL needs shared memory, which doesn't work for a file on a network share.
+    conn = sqlite3.connect(WORKER_STORE_PATH, timeout=30, isolation_level=None)
+    if not worker_store_ready:
+        with worker_store_lock:
+            if not worker_store_ready:
+                conn.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                             "id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, position INTEGER NOT NULL, "
+                             "track TEXT NOT NULL, options TEXT NOT NULL, folder TEXT NOT NULL, file_stem TEXT, "
+                             "deadline REAL NOT NULL, status TEXT NOT NULL, worker TEXT, heartbeat REAL, "
+                             "stage TEXT, info TEXT, output TEXT, error TEXT, seq INTEGER NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id)")
+                conn.execute("CREATE INDEX IF NOT EXISTS tasks_job ON tasks (job_id, seq)")
+                conn.execute("CREATE INDEX IF NOT EXISTS tasks_seq ON tasks (seq)")
+                worker_store_ready = True
+    return conn
+
+@contextmanager
+def worker_store_transaction():
+    """Yields a connection inside a write transaction, so claims by several workers don't collide."""
+    conn = worker_store()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+NEXT_SEQ = "(SELECT COALESCE(MAX(seq), 0) + 1 FROM tasks)"
+
+def queue_remote_track(job_id, position, track, options, folder, file_stem, deadline):
+    with worker_store_transaction() as conn:
+        return conn.execute("INSERT INTO tasks (job_id, position, track, options, folder, file_stem, deadline, "
+                            f"status, seq) VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', {NEXT_SEQ})",
+                            (job_id, position, json.dumps(track), json.dumps(options),
+                             os.path.relpath(folder, DOWNLOADS_DIR), file_stem, deadline)).lastrowid
+
+def claim_remote_track(worker_id):
+    """
+    Hands the oldest queued track to the worker, or a running one whose worker stopped sending
+    heartbeats. Returns the task as a dict, or None if there is nothing to do.
+    """
+    now = time.time()
+    with worker_store_transaction() as conn:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM tasks WHERE status = 'queued' OR (status = 'running' AND heartbeat < ?) "
+                           "ORDER BY id LIMIT 1", (now - WORKER_LEASE,)).fetchone()
+        if row is None:
+            return None
+        if row["status"] == "running":
+            logger.warning(f"Taking over track {row['position']} of job {row['job_id']} from {row['worker']}")
+        conn.execute(f"UPDATE tasks SET status = 'running', worker = ?, heartbeat = ?, seq = {NEXT_SEQ} WHERE id = ?",
+                     (worker_id, now, row["id"]))
+        return dict(row)
+
+def update_remote_track(task_id, worker_id, **fields):
+    """Updates a running track. Returns False if the track isn't the worker's anymore (taken over or cancelled)."""
+    assignments = "".join(f"{name} = ?, " for name in fields)
+    try:
+        with worker_store_transaction() as conn:
+            return conn.execute(f"UPDATE tasks SET {assignments}seq = {NEXT_SEQ} "
+                                "WHERE id = ? AND worker = ? AND status = 'running'",
+                                (*fields.values(), task_id, worker_id)).rowcount > 0
+    except sqlite3.Error as e:
+        logger.warning(f"Could not update the job store: {e}")
+        return False
+
+def cancel_remote_tracks(job_id):
+    with worker_store_transaction() as conn:
+        conn.execute(f"UPDATE tasks SET status = 'cancelled', seq = {NEXT_SEQ} "
+                     "WHERE job_id = ? AND status IN ('queued', 'running')", (job_id,))
+
+def forget_remote_tracks(job_id):
+    with worker_store_transaction() as conn:
+        conn.execute("DELETE FROM tasks WHERE job_id = ?", (job_id,))
+
+class RemoteTrackRunner:
+    """
+    Runs the tracks of a job on the workers of the shared job store, with the same submit() as
+    LocalTrackRunner. A poll thread relays the workers' progress to the job and resolves the
+    futures once the tracks are finished. Tracks still open WORKER_LEASE after the deadline fail.
+    """
+    def __init__(self, job_id, options, deadline):
+        self.job_id = job_id
+        self.options = options
+        self.deadline = deadline
+        # task ID -> (future, position, name, on_done)
+        self.pending = {}
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self.poll_loop, daemon=True, name=f"ssssd-remote-{job_id[:8]}")
+        self.thread.start()
+
+    def submit(self, track, folder, file_stem=None, position=1, on_done=None):
+        future = Future()
+        with self.lock:
+            task_id = queue_remote_track(self.job_id, position, track, self.options, folder, file_stem,
+                                         self.deadline)
+            self.pending[task_id] = (future, position, track_basename(track), on_done)
+        return future
+
+    def poll(self):
+        conn = worker_store()
+        try:
+            with self.lock:
+                rows = conn.execute("SELECT id, seq, status, stage, info, output, error FROM tasks "
+                                    "WHERE job_id = ? AND seq > ? ORDER BY seq", (self.job_id, self.seq)).fetchall()
+                for task_id, seq, status, stage, info, output, error in rows:
+                    self.seq = seq
+                    if task_id not in self.pending:
+                        continue
+                    future, position, name, on_done = self.pending[task_id]
+                    if status == "done":
+                        output_path = os.path.join(DOWNLOADS_DIR, output)
+                        # The file has to have reached the shared folder as seen from here
+                        self.finish(task_id, output_path if os.path.exists(output_path) else None)
+                    elif status in ("failed", "cancelled"):
+                        report_track_progress(self.job_id, position, name, "failed", error=error)
+                        self.finish(task_id, None)
+                    elif stage:
+                        report_track_progress(self.job_id, position, name, stage, **json.loads(info or "{}"))
+        finally:
+            conn.close()
+
+    def finish(self, task_id, output_path):
+        future, _, _, on_done = self.pending.pop(task_id)
+        try:
+            if on_done:
+                on_done(output_path)
+        finally:
+            future.set_result(output_path)
+
+    def fail_pending(self, error):
+        with self.lock:
+            for task_id, (_, position, name, _) in list(self.pending.items()):
+                report_track_progress(self.job_id, position, name, "failed", error=error)
+                self.finish(task_id, None)
+
+    def poll_loop(self):
+        while True:
+            try:
+                self.poll()
+            except sqlite3.Error as e:
+                logger.warning(f"Could not read the job store: {e}")
+            with self.lock:
+                done = self.closed and not self.pending
+            if done:
+                return
+            if self.pending and time.time() > self.deadline + WORKER_LEASE:
+                logger.error(f"Job {self.job_id} ran out of time waiting for the workers")
+                self.cancel("The job's time budget was used up.")
+            time.sleep(WORKER_POLL_INTERVAL)
+
+    def cancel(self, error):
+        try:
+            cancel_remote_tracks(self.job_id)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not cancel the tracks of job {self.job_id}: {e}")
+        self.fail_pending(error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.cancel(f"Download failed: {exc}")
+        with self.lock:
+            self.closed = True
+        self.thread.join()
+        try:
+            forget_remote_tracks(self.job_id)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not remove the tracks of job {self.job_id} from the job store: {e}")
+
+def run_remote_track(worker_id, task):
+    """Runs one claimed track with the pipeline of this host and reports the outcome to the store."""
+    last_report = [0.0]
+    last_error = [None]
+    def report(job_id, position, name, stage, **info):
+        now = time.monotonic()
+        if stage == "download" and now - last_report[0] < PROGRESS_INTERVAL:
+            return
+        last_report[0] = now
+        if stage == "failed":
+            last_error[0] = info.get("error")
+        update_remote_track(task["id"], worker_id, stage=stage, info=json.dumps(info))
+    
+    process_track = make_track_processor(task["job_id"], json.loads(task["options"]), task["deadline"], report=report)
+    folder = os.path.join(DOWNLOADS_DIR, task["folder"])
+    logger.info(f"Running track {task['position']} of job {task['job_id']}")
+    try:
+        os.makedirs(folder, exist_ok=True)
+        output_path = process_track(json.loads(task["track"]), folder, task["file_stem"], task["position"])
+    except Exception as e:
+        logger.exception(f"Track {task['position']} of job {task['job_id']} crashed")
+        output_path = None
+        last_error[0] = str(e)
+    if output_path:
+        update_remote_track(task["id"], worker_id, status="done", output=os.path.relpath(output_path, DOWNLOADS_DIR))
+    else:
+        update_remote_track(task["id"], worker_id, status="failed", error=last_error[0])
+
+def worker_heartbeat(worker_id):
+    """Keeps the worker's running tracks from being taken over while it is alive."""
+    while True:
+        time.sleep(WORKER_LEASE / 4)
+        try:
+            with worker_store_transaction() as conn:
+                conn.execute("UPDATE tasks SET heartbeat = ? WHERE worker = ? AND status = 'running'",
+                             (time.time(), worker_id))
+        except sqlite3.Error as e:
+            logger.warning(f"Could not send the heartbeat: {e}")
+
+def worker_loop(worker_id):
+    while True:
+        try:
+            task = claim_remote_track(worker_id)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not read the job store: {e}")
+            task = None
+        if task is None:
+            time.sleep(WORKER_POLL_INTERVAL)
+            continue
+        run_remote_track(worker_id, task)
+
+def run_worker(threads=TRACK_WORKERS):
+    """
+    Runs tracks from the shared job store until stopped, TRACK_WORKERS at a time.
+    The fetch and FFmpeg limits, the track cache and the match index are this host's own.
+    Workers don't run the janitor, the web process owns the downloads folder.
+    """
+    if not WORKER_STORE_PATH:
+        raise SystemExit("Set SSSSD_WORKER_STORE to the shared job store to run a worker.")
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    logger.info(f"Worker {worker_id} taking tracks from {WORKER_STORE_PATH}")
+    threading.Thread(target=worker_heartbeat, args=(worker_id,), daemon=True).start()
+    loops = [threading.Thread(target=worker_loop, args=(worker_id,), daemon=True, name=f"ssssd-worker-{i}")
+             for i in range(threads)]
+    for loop in loops:
+        loop.start()
+    for loop in loops:
+        loop.join()
+
+def extract_spotify_id(url):
+    regex = r"open\.spotify\.com/(track|album|playlist)/([a-zA-Z0-9]+)"
+    match = re.search(regex, url)
+    if match:
+        return match.group(1), match.group(2)
+    return None, None
+
+def track_basename(track):
+    artist = ", ".join([a["name"] for a in track.get("artists", [])])
+    title = track.get("name", "")
+    return sanitize_filename(f"{artist} - {title}")
+
+def build_query(track):
+    artist = ", ".join([a["name"] for a in track.get("artists", [])])
+    title = track.get("name", "")
+    return f"{artist} - {title} official audio"
+
+def sanitize_filename(name):
+    return re.sub(r'[\\/*?:"<>|]', "", name)
+
+# -------------------------------
+# Janitor
+# -------------------------------
+# Every job owns the folder DOWNLOADS_DIR/<job ID>. The janitor removes whole job folders
+# once they haven't been used for DOWNLOADS_MAX_AGE, and the least recently used ones while
+# the downloads folder is over DOWNLOADS_MAX_BYTES. Folders of queued or running jobs, folders
+# a response is still reading from and folders used in the last DOWNLOADS_GRACE are kept.
+transfers_lock = threading.Lock()
+# job ID -> number of responses reading from its folder
+active_transfers = {}
+# job ID -> time its files were last served
+last_served = {}
+# Job folders being removed, new responses for them get a 404
+evicting_jobs = set()
+janitor_wakeup = threading.Event()
+downloads_bytes = 0
+
+def begin_transfer(job_id):
+    """Registers a response reading from the job's folder. Returns False if the folder is being removed."""
+    with transfers_lock:
+        if job_id in evicting_jobs:
+            return False
+        active_transfers[job_id] = active_transfers.get(job_id, 0) + 1
+        last_served[job_id] = time.time()
+        return True
+
+def end_transfer(job_id):
+    with transfers_lock:
+        active_transfers[job_id] -= 1
+        if not active_transfers[job_id]:
+            del active_transfers[job_id]
+        last_served[job_id] = time.time()
+
+def end_transfer_on_close(response, job_id):
+    """Ends the transfer once the server is done with the response."""
+    ended = []
+    def end():
+        if not ended:
+            ended.append(True)
+            end_transfer(job_id)
+    response.call_on_close(end)
+    if response.direct_passthrough:
+        # send_file bodies go to the server as is, without the response's close callbacks. The
+        # body object itself has to be kept, servers only use sendfile for their own file wrapper.
+        body = response.response
+        close_body = getattr(body, "close", None)
+        def close():
+            try:
+                if close_body:
+                    close_body()
+            finally:
+                end()
+        body.close = close
+    return response
+
+def folder_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def evict_job_folder(path):
+    """Removes a job's folder unless a response is reading from it. Returns whether it was removed."""
+    job_id = os.path.basename(path)
+    with transfers_lock:
+        if active_transfers.get(job_id):
+            return False
+        evicting_jobs.add(job_id)
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+    except Exception as e:
+        logger.error(f"Failed to delete {path}. Reason: {e}")
+        return False
+    finally:
+        with transfers_lock:
+            evicting_jobs.discard(job_id)
+            last_served.pop(job_id, None)
+    # The job's files are gone, so it is forgotten like a pruned job
+    with jobs_lock:
+        jobs.pop(job_id, None)
+    return True
+
+def run_janitor():
+    """Removes unused job folders by age, then by size until the downloads folder fits its limit."""
+    global downloads_bytes
+    prune_jobs()
+    if not os.path.isdir(DOWNLOADS_DIR):
+        return
+    now = time.time()
+    with jobs_lock:
+        active = {j["id"] for j in jobs.values() if j["status"] in ("queued", "running")}
+        finished = {j["id"]: j["finished"] or 0 for j in jobs.values()}
+    total = 0
+    candidates = []
+    for entry in os.scandir(DOWNLOADS_DIR):
+        try:
+            size = folder_size(entry.path) if entry.is_dir(follow_symlinks=False) else entry.stat().st_size
+            modified = entry.stat(follow_symlinks=False).st_mtime
+        except OSError:
+            continue
+        total += size
+        if entry.name in active:
+            continue
+        with transfers_lock:
+            served = last_served.get(entry.name, 0)
+        candidates.append((max(modified, finished.get(entry.name, 0), served), size, entry.path))
+    
+    # Least recently used first
+    candidates.sort()
+    for last_used, size, path in candidates:
+        idle = now - last_used
+        if idle > DOWNLOADS_MAX_AGE:
+            reason = "age"
+        elif total > DOWNLOADS_MAX_BYTES and idle > DOWNLOADS_GRACE:
+            reason = "quota"
+        elif total > DOWNLOADS_MAX_BYTES:
+            continue
+        else:
+            break
+        if evict_job_folder(path):
+            total -= size
+            count_metric("ssssd_evicted_jobs_total", reason=reason)
+            logger.info(f"Removed {os.path.basename(path)} from the downloads folder ({reason})")
+    downloads_bytes = total
+    if total > DOWNLOADS_MAX_BYTES:
+        logger.warning(f"Downloads folder is over its size limit ({total} bytes), everything left is in use")
+
+def periodic_cleanup():
+    while True:
+        janitor_wakeup.wait(JANITOR_INTERVAL)
+        janitor_wakeup.clear()
+        try:
+            run_janitor()
+        except Exception as e:
+            logger.error(f"Janitor run failed: {e}")
+
+janitor_thread = None
+
+def start_janitor():
+    """Starts the janitor once. Folders left over from a previous run are removed by age like any other."""
+    global janitor_thread
+    with transfers_lock:
+        if janitor_thread is None:
+            janitor_thread = threading.Thread(target=periodic_cleanup, daemon=True, name="ssssd-janitor")
+            janitor_thread.start()
+
+def run_batch_cli(argv):
+    """
+    Headless batch download, e.g. for nightly library syncs:
+        python main.py batch --format m4a --output library URL [URL ...]
+        python main.py batch --file urls.txt
+    Runs one batch job in this process (or on the workers of the job store) and puts the
+    tracks into the output folder, one folder per album or playlist. Returns the exit code.
+    """
+    global DOWNLOADS_DIR
+    parser = argparse.ArgumentParser(prog="main.py batch", description="Download many Spotify URLs at once.")
+    parser.add_argument("urls", nargs="*", help="Spotify track, album or playlist URLs")
+    parser.add_argument("--file", "-f", help="Text file with one URL per line ('-' reads standard input)")
+    parser.add_argument("--output", "-o", default="output", help="Folder the tracks are put in (default: output)")
+    parser.add_argument("--format", default="mp3", choices=list(AUDIO_FORMATS), help="Audio format")
+    parser.add_argument("--quality", default="192", help="MP3 bitrate (kbps)")
+    parser.add_argument("--metadata", default="all", choices=list(METADATA_PROFILES), help="Metadata option")
+    parser.add_argument("--order", default="as_is", choices=["as_is", "reverse"], help="Playlist order")
+    args = parser.parse_args(argv)
+    
+    urls = list(args.urls)
+    if args.file:
+        with (sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")) as f:
+            urls += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    if not urls:
+        parser.error("no Spotify URLs given")
+    options, invalid = batch_options(urls, {"audio_format": args.format, "sound_quality": args.quality,
+                                            "metadata_options": args.metadata, "playlist_order": args.order})
+    if invalid:
+        parser.error("invalid Spotify URLs: " + ", ".join(map(str, invalid)))
+    
+    # The janitor of a server sharing the downloads folder doesn't know this job. Without workers
+    # the job gets a scratch folder of its own next to the output (so tracks can be hard linked).
+    # Workers need the shared folder, there the job folder's modification time is kept fresh,
+    # which the janitor takes as "in use".
+    os.makedirs(args.output, exist_ok=True)
+    if not WORKER_STORE_PATH:
+        DOWNLOADS_DIR = tempfile.mkdtemp(prefix=".ssssd-", dir=args.output)
+    job_id = create_job(options)
+    job_dir = os.path.join(DOWNLOADS_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    finished = threading.Event()
+    def keep_fresh():
+        while not finished.wait(JANITOR_INTERVAL / 2):
+            try:
+                os.utime(job_dir)
+            except OSError:
+                pass
+    threading.Thread(target=keep_fresh, daemon=True).start()
+    try:
+        run_job(job_id)
+        job = get_job(job_id)
+        if job["status"] == "failed":
+            print(f"Batch failed: {job['error']}", file=sys.stderr)
+            return 1
+        for arcname, path in job["entries"]:
+            destination = os.path.join(args.output, arcname)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            link_or_copy(path, destination)
+    finally:
+        finished.set()
+        shutil.rmtree(job_dir if WORKER_STORE_PATH else DOWNLOADS_DIR, ignore_errors=True)
+    failed = [track for track in job["tracks"] if track.get("stage") == "failed"]
+    print(f"{len(job['entries'])} tracks saved to {args.output}, {len(failed)} failed")
+    for track in failed:
+        print(f"  failed: {track['name']} ({track.get('error') or 'unknown error'})", file=sys.stderr)
+    return 1 if failed else 0
+
+def serve(host=SERVER_HOST, port=SERVER_PORT):
+    """
+    Runs the app on waitress (works on Windows too). Jobs and caches live in this process,
+    so it is one process with SERVER_THREADS request threads; file bodies are sent by
+    waitress' I/O thread, not the request threads. See wsgi.py for gunicorn.
+    """
+    app = create_app()
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        logger.warning("waitress is not installed, falling back to Flask's development server")
+        app.run(host=host, port=port, threaded=True, use_reloader=False)
+        return
+    waitress_serve(app, host=host, port=port, threads=SERVER_THREADS, ident="SSSSD")
+
+if __name__ == "__main__":
+    # "python main.py worker" runs tracks from the shared job store instead of serving the app,
+    # "python main.py batch ..." downloads a list of URLs without the web interface
+    if sys.argv[1:2] == ["worker"]:
+        run_worker()
+    elif sys.argv[1:2] == ["batch"]:
+        sys.exit(run_batch_cli(sys.argv[2:]))
+    else:
+        serve()
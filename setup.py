@@ -1,34 +1,57 @@
-import os
-import sys
-import subprocess
-
-# Define the target folder for local installations
-LIBS_DIR = os.path.join(os.getcwd(), "libs")
-if not os.path.exists(LIBS_DIR):
-    os.makedirs(LIBS_DIR)
-
-# List of required packages (all third-party modules used in your code)
-required_packages = [
-    "spotipy",
-    "yt-dlp",
-    "requests",
-    "flask",
-    "jinja2"
-]
-
-def install_packages(packages):
-    for pkg in packages:
-        try:
-            # Replace hyphens with underscores for module names (e.g., yt-dlp -> yt_dlp)
-            __import__(pkg.replace('-', '_'))
-            print(f"{pkg} is already installed.")
-        except ImportError:
-            print(f"Installing {pkg} into {LIBS_DIR} ...")
-            subprocess.check_call([
-                sys.executable, "-m", "pip", "install", "--target=" + LIBS_DIR, pkg
-            ])
-
-install_packages(required_packages)
-print("All dependencies installed/updated in the 'libs' folder.")
-print("Launching main application...")
-subprocess.check_call([sys.executable, "main.py"])
+import os
+import sys
+import json
+import importlib.util
+import subprocess
+
+# Define the target folder for local installations
+LIBS_DIR = os.path.join(os.getcwd(), "libs")
+if not os.path.exists(LIBS_DIR):
+    os.makedirs(LIBS_DIR)
+# Packages in the libs folder have to be importable here and in main.py
+sys.path.insert(0, LIBS_DIR)
+# Written after a successful check, the check is skipped while the package list and Python stay the same
+STAMP_FILE = os.path.join(LIBS_DIR, ".installed.json")
+
+# List of required packages (all third-party modules used in your code)
+required_packages = [
+    "spotipy",
+    "yt-dlp",
+    "requests",
+    "flask",
+    "jinja2",
+    "waitress"
+]
+
+def install_packages(packages):
+    for pkg in packages:
+        # Replace hyphens with underscores for module names (e.g., yt-dlp -> yt_dlp).
+        # find_spec only looks the module up, it doesn't import it.
+        if importlib.util.find_spec(pkg.replace('-', '_')) is not None:
+            print(f"{pkg} is already installed.")
+        else:
+            print(f"Installing {pkg} into {LIBS_DIR} ...")
+            subprocess.check_call([
+                sys.executable, "-m", "pip", "install", "--target=" + LIBS_DIR, pkg
+            ])
+
+def current_stamp():
+    return {"packages": required_packages, "python": sys.executable, "version": sys.version}
+
+def read_stamp():
+    try:
+        with open(STAMP_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+if read_stamp() != current_stamp():
+    install_packages(required_packages)
+    with open(STAMP_FILE, "w", encoding="utf-8") as f:
+        json.dump(current_stamp(), f)
+    print("All dependencies installed/updated in the 'libs' folder.")
+print("Launching main application...")
+env = dict(os.environ)
+env["PYTHONPATH"] = os.pathsep.join(p for p in (LIBS_DIR, env.get("PYTHONPATH")) if p)
+# Arguments are passed on, e.g. "python setup.py worker"
+sys.exit(subprocess.call([sys.executable, "main.py"] + sys.argv[1:], env=env))
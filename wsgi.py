@@ -0,0 +1,7 @@
+# WSGI entry point for production servers, e.g.
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#   waitress-serve --threads=32 --port=5000 wsgi:app
+# "python main.py" serves the same app on waitress.
+from main import create_app
+
+app = create_app()